@@ -1,21 +1,120 @@
+import os
 import sys
-from PySide6.QtCore import Qt, QStandardPaths, QFile, QFileInfo, QTextStream, QIODevice, QDir, QDateTime, QSize
-from PySide6.QtGui import QIcon
+import time
+import sqlite3
+import threading
+
+# Taken before Qt is imported, so --profile-startup counts the imports
+startup_time = time.perf_counter()
+
+from PySide6.QtCore import Qt, QObject, QStandardPaths, QFile, QFileInfo, QDir, QDateTime, QSize, QTimer, Signal
+from PySide6.QtGui import QIcon, QKeySequence, QShortcut, QTextCursor
 from PySide6.QtWidgets import (QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog, QGridLayout,
-                               QLabel, QLineEdit, QTextEdit, QComboBox, QMessageBox)
+                               QLabel, QLineEdit, QComboBox, QMessageBox, QListWidget, QListWidgetItem,
+                               QProgressDialog, QInputDialog)
 
+from ykpasyncdb import AsyncDatabase
+from ykpautosave import AutoSave
+from ykpbackup import BackupCancelled, RestoreError, backup_database, restore_database
 from ykphandler import Commands
-from ykpdatabase import Database
+from ykpdatabase import BasicConfig, Database, format_time
+from ykpeditor import Editor, FileLoader, FileSaveTask, WindowedFileView
+from ykpfileio import MappedTextFile
+from ykpjournal import Journal, replay_journal
+from ykpmaintenance import Maintenance
+from ykpmerge import Merger, merge_modes
+from ykpnotelist import NoteListModel
 from ykpsettings import Settings
+from ykptrace import traced, span
+
+
+class BackupTask(QObject):
+    progress = Signal(int, int)
+    finished = Signal(str)
+    failed = Signal(str)
+    cancelled = Signal()
+
+    def __init__(self, source_path, target_path, compress=False):
+        super(BackupTask, self).__init__()
+
+        self.source_path = source_path
+        self.target_path = target_path
+        self.compress = compress
+        self.cancel_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='YKPenBackup', daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    # Runs on the backup thread, the signals are delivered to the UI thread
+    def run(self):
+        try:
+            target_path, _ = backup_database(self.source_path, self.target_path, progress=self.progress.emit,
+                                             cancel_event=self.cancel_event, compress=self.compress)
+        except BackupCancelled:
+            self.cancelled.emit()
+        except (OSError, sqlite3.Error) as error:
+            self.failed.emit(str(error))
+        else:
+            self.finished.emit(target_path)
+
+
+class StartupProfile:
+    def __init__(self, start):
+        super(StartupProfile, self).__init__()
+
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        for phase, duration in self.phases:
+            print('{:<28} {:8.1f} ms'.format(phase, duration * 1000), file=sys.stderr)
+        print('{:<28} {:8.1f} ms'.format('total', (self.last - self.start) * 1000), file=sys.stderr)
 
 
 class YKPen(QWidget):
-    def __init__(self):
+    database_progress = Signal(str, int, int)
+    merge_progress = Signal(str, int, int)
+
+    def __init__(self, startup_profile=None):
         super(YKPen, self).__init__()
 
-        self.commands = Commands()
-        self.database = Database()
-        self.settings_panel = Settings()
+        self.startup_profile = startup_profile
+
+        # The schema checks and the note list are left for after the first paint, see start_database()
+        self.database = Database(initialize=False)
+        self.commands = Commands(self.database)
+        self.database_loaded = False
+        self.first_paint_done = False
+
+        # Every database call runs on the worker of async_database, the window only gets the results
+        self.async_database = AsyncDatabase(self.database)
+
+        # The About panel is built when it is first opened
+        self.settings_panel = None
+        self.auto_save = AutoSave(self.read_update_snapshot, self.database.update_record_from_id, self.async_database)
+        self.maintenance = Maintenance(self.database)
+        self.maintenance_timer = QTimer()
+        self.maintenance_future = None
+
+        # Ctrl+H lists the earlier versions of the open note, see show_history()
+        self.history_shortcut = QShortcut(QKeySequence('Ctrl+H'), self)
+
+        # Notes written by other windows and processes are picked up by polling, see poll_changes()
+        self.change_timer = QTimer()
+        self.change_poll_pending = False
+        self.backup_task = None
+        self.backup_progress_dialog = None
 
         self.main_layout = QVBoxLayout()
 
@@ -26,6 +125,7 @@ class YKPen(QWidget):
         self.settings_layout = QHBoxLayout()
 
         self.title_layout = QHBoxLayout()
+        self.search_results_layout = QHBoxLayout()
         self.editor_layout = QGridLayout()
 
         self.bottom_layout = QHBoxLayout()
@@ -45,12 +145,33 @@ class YKPen(QWidget):
         self.settings_button = QPushButton()
 
         self.text_list_combobox = QComboBox()
+        self.note_list_model = NoteListModel(self.async_database)
 
         self.title_entry = QLineEdit()
-        self.editor = QTextEdit()
+        self.search_entry = QLineEdit()
+        self.search_results_list = QListWidget()
+        self.search_timer = QTimer()
+        self.editor = Editor()
+        self.file_loader = FileLoader(self.editor)
+        self.file_progress_dialog = None
+        self.file_view = WindowedFileView()
+        self.file_encoding = 'utf-8'
+        self.file_save_task = None
+        self.file_save_option = None
+        self.file_save_revision = None
+
+        # Size and modification time of the opened file while the editor holds it unchanged, see describe_journal_text()
+        self.file_base = None
+
+        # Documents above this many characters are written on a worker thread when saved from the button
+        self.background_save_threshold = 1024 * 1024
+
+        # Files above this size may be opened read-only, decoding only the visible region
+        self.windowed_view_threshold = 100 * 1024 * 1024
 
         self.creation_time_label = QLabel()
         self.last_modified_time_label = QLabel()
+        self.save_status_label = QLabel()
 
         self.file_path_entry = QLineEdit()
 
@@ -58,7 +179,26 @@ class YKPen(QWidget):
         self.file_text_changes_status = False
         self.new_text_changes_status = False
 
-        screen = app.primaryScreen()
+        # The note id, title and file path as last written to the database, and the hash of the text
+        self.saved_fields = None
+        self.saved_text_hash = None
+
+        # The note the title, editor and file path show, None while they hold a file or a new text
+        self.shown_id = None
+
+        # Text that is neither in the database nor saved to its file is journaled, so a crash does not lose it
+        self.journal = Journal(self.editor.document(),
+                               os.path.join(BasicConfig.read_profile_folder_path(), 'journal'),
+                               self.describe_journal_text)
+        self.recovery_checked = False
+
+        # The note being read for the editor, which is read-only until fill_note() gets it
+        self.loading_id = None
+
+        # A new note is being inserted, save_data() waits for its id before inserting again
+        self.inserting_note = False
+
+        screen = QApplication.primaryScreen()
         screen_width = screen.availableSize().width()
         screen_height = screen.availableSize().height()
 
@@ -95,8 +235,17 @@ class YKPen(QWidget):
 
         self.title_entry.setStyleSheet('border:1px solid rgb(100, 100, 100); border-radius: 2px; '
                                        'background: rgb(30, 30, 30); color: white; font-size: 11pt')
+        self.search_entry.setStyleSheet('border:1px solid rgb(100, 100, 100); border-radius: 2px; '
+                                        'background: rgb(30, 30, 30); color: white')
+        self.search_results_list.setStyleSheet(
+            'QListWidget {border: 1px solid rgb(60, 60, 60); border-radius: 2px; background: rgb(30, 30, 30); '
+            'color: white} '
+            'QListWidget::item {height: 26px} '
+            'QListWidget::item::selected {background: rgb(50, 50, 50)}')
         self.editor.setStyleSheet('border:1px solid rgb(60, 60, 60); border-radius: 2px; background: rgb(30, 30, 30); '
                                   'color: white; font-size: 11pt')
+        self.file_view.view.setStyleSheet('border:1px solid rgb(60, 60, 60); border-radius: 2px; '
+                                          'background: rgb(30, 30, 30); color: white; font-size: 11pt')
         self.file_path_entry.setStyleSheet('border:1px solid rgb(60, 60, 60); border-radius: 2px; background: black; '
                                            'color: white')
         # Dark theme -- end
@@ -104,6 +253,7 @@ class YKPen(QWidget):
         self.main_layout.setContentsMargins(0, 0, 0, 0)
         self.top_layout.setContentsMargins(10, 5, 10, 0)
         self.title_layout.setContentsMargins(10, 0, 10, 0)
+        self.search_results_layout.setContentsMargins(10, 0, 10, 0)
         self.editor_layout.setContentsMargins(2, 0, 2, 0)
         self.bottom_layout.setContentsMargins(10, 0, 10, 5)
 
@@ -118,6 +268,7 @@ class YKPen(QWidget):
         self.settings_layout.setAlignment(Qt.AlignmentFlag.AlignRight)
 
         self.main_layout.addLayout(self.title_layout)
+        self.main_layout.addLayout(self.search_results_layout)
         self.main_layout.addLayout(self.editor_layout)
         self.main_layout.addLayout(self.bottom_layout)
 
@@ -156,7 +307,7 @@ class YKPen(QWidget):
 
         self.replace_database_button.setIcon(QIcon("icons/replace-database.png"))
         self.replace_database_button.setIconSize(QSize(20, 20))
-        self.replace_database_button.setToolTip("Replace database")
+        self.replace_database_button.setToolTip("Merge or replace database")
         self.replace_database_button.setFixedSize(30, 30)
 
         self.database_operations_layout.addWidget(self.database_operations_label)
@@ -172,19 +323,35 @@ class YKPen(QWidget):
 
         self.settings_layout.addWidget(self.settings_button)
 
-        self.text_list = self.read_text_list()
-        self.text_list_combobox.addItems(self.text_list)
+        self.note_list_model.wait_for_database()
+        self.text_list_combobox.setModel(self.note_list_model)
         self.text_list_combobox.setEditable(False)
-        self.text_list_combobox.setFixedSize(145, 30)
+        self.text_list_combobox.setFixedSize(175, 30)
         self.text_list_combobox.setCurrentText("New")
 
-        self.title_entry.setFixedSize(750, 30)
+        self.title_entry.setFixedSize(720, 30)
 
         self.title_layout.setAlignment(Qt.AlignLeft)
         self.title_layout.addWidget(self.text_list_combobox)
         self.title_layout.addWidget(self.title_entry)
+        self.title_layout.addWidget(self.search_entry)
+
+        self.search_entry.setFixedSize(145, 30)
+        self.search_entry.setPlaceholderText("Search")
+        self.search_entry.setClearButtonEnabled(True)
+        self.search_entry.setEnabled(False)
+
+        self.search_results_list.setFixedHeight(180)
+        self.search_results_list.hide()
+        self.search_results_layout.addWidget(self.search_results_list)
+
+        # Searches run once typing pauses
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
 
         self.editor_layout.addWidget(self.editor)
+        self.editor_layout.addWidget(self.file_view)
+        self.file_view.hide()
 
         self.time_layout.setAlignment(Qt.AlignLeft)
         self.file_path_layout.setAlignment(Qt.AlignRight)
@@ -197,12 +364,13 @@ class YKPen(QWidget):
 
         self.time_layout.addWidget(self.creation_time_label)
         self.time_layout.addWidget(self.last_modified_time_label)
+        self.time_layout.addWidget(self.save_status_label)
         self.file_path_layout.addWidget(self.file_path_entry)
         self.bottom_layout.addLayout(self.time_layout)
         self.bottom_layout.addLayout(self.file_path_layout)
 
         self.open_button.clicked.connect(self.open_file)
-        self.save_file_button.clicked.connect(self.save_file)
+        self.save_file_button.clicked.connect(self.save_file_clicked)
         self.save_data_button.clicked.connect(self.save_data)
         self.remove_data_button.clicked.connect(self.remove_data)
 
@@ -211,12 +379,193 @@ class YKPen(QWidget):
 
         self.settings_button.clicked.connect(self.open_settings)
 
+        self.file_loader.progress.connect(self.show_file_progress)
+        self.file_loader.finished.connect(self.finish_file_loading)
+
         self.text_list_combobox.activated.connect(self.load_database)
 
+        # Free pages are reclaimed on the database worker while nothing waits to be written, from the time the
+        # database is prepared, see finish_startup()
+        self.maintenance_timer.setInterval(60000)
+        self.maintenance_timer.timeout.connect(self.run_maintenance)
+
+        self.history_shortcut.activated.connect(self.show_history)
+
+        self.change_timer.setInterval(1000)
+        self.change_timer.timeout.connect(self.poll_changes)
+
+        self.search_entry.textChanged.connect(self.search_timer.start)
+        self.search_timer.timeout.connect(self.search_data)
+        self.search_results_list.itemActivated.connect(self.open_search_result)
+
         self.title_entry.textChanged.connect(self.auto_save_data)
+        self.title_entry.textChanged.connect(self.journal.record_fields)
         self.editor.textChanged.connect(self.auto_save_data)
         self.file_path_entry.textChanged.connect(self.auto_save_data)
+        self.file_path_entry.textChanged.connect(self.journal.record_fields)
+
+        self.async_database.failed.connect(self.fail_database_request)
+        self.database_progress.connect(self.show_database_progress)
+        self.merge_progress.connect(self.show_merge_progress)
+
+        self.set_database_widgets_enabled(False)
+
+        if self.startup_profile is not None:
+            self.startup_profile.mark('window')
+
+    # Work left out of __init__ starts once the window is on screen
+    def paintEvent(self, event):
+        super(YKPen, self).paintEvent(event)
+
+        if not self.first_paint_done:
+            self.first_paint_done = True
+            if self.startup_profile is not None:
+                self.startup_profile.mark('first paint')
+            QTimer.singleShot(0, self.start_database)
+
+    def start_database(self):
+        self.async_database.submit(self.prepare_database, callback=self.finish_startup)
+
+    # Runs on the database worker, ahead of any write. Older databases are upgraded here in batches.
+    def prepare_database(self):
+        self.database.initialize_db(self.database_progress.emit)
+        return self.database.read_ids_page(None, self.note_list_model.page_size)
+
+    def show_database_progress(self, step, done, total):
+        self.save_status_label.setText('Upgrading database: {} {}/{}'.format(step, done, total))
+
+    def finish_startup(self, page):
+        self.note_list_model.append_page(page)
+        self.database_loaded = True
+        self.set_database_widgets_enabled(True)
+        self.save_status_label.setText('')
+        self.change_timer.start()
+        self.maintenance_timer.start()
+
+        if self.startup_profile is not None:
+            self.startup_profile.mark('database and note list')
+            self.startup_profile.report()
+            self.startup_profile = None
+
+        if not self.recovery_checked:
+            self.recovery_checked = True
+            self.recover_journal()
+
+    # Offer the text journaled by a session that did not exit properly. One text is recovered per start, the
+    # journals of other such sessions are offered at the next one.
+    def recover_journal(self):
+        for journal_path in self.journal.find_recoverable():
+            claimed_path = self.journal.claim_journal(journal_path)
+            if claimed_path is None:
+                continue
+
+            try:
+                state = replay_journal(claimed_path)
+            except (OSError, ValueError, KeyError) as error:
+                print('{}: {}'.format(journal_path, error), file=sys.stderr)
+                state = None
+
+            if state is None or not (state['title'] or state['text']):
+                self.journal.remove_journal(claimed_path)
+                continue
+
+            name = state['title'] or state['file_path'] or state['text'].strip().split('\n')[0][:80]
+            recovery_box = QMessageBox()
+            recovery_box.setText("YKPen was not closed properly.\nText that was not saved can be recovered:\n\n" +
+                                 name + "\n\nDo you want to recover it?")
+            yes_button = recovery_box.addButton(QMessageBox.Yes)
+            recovery_box.addButton(QMessageBox.No)
+            recovery_box.exec()
+
+            if recovery_box.clickedButton() == yes_button:
+                self.restore_journal_text(state)
+                self.journal.remove_journal(claimed_path)
+                return
 
+            self.journal.remove_journal(claimed_path)
+
+    def restore_journal_text(self, state):
+        self.clear_all_contents()
+
+        if state['context'] == 'file':
+            self.text_list_combobox.setCurrentText('File')
+            if state['file_path'] and QFile.exists(state['file_path']):
+                mapped_file = MappedTextFile(state['file_path'])
+                self.file_encoding = mapped_file.encoding
+                mapped_file.close()
+                self.open_file_status = True
+        else:
+            self.text_list_combobox.setCurrentText('New')
+
+        self.title_entry.setText(state['title'])
+        self.editor.setPlainText(state['text'])
+        self.file_path_entry.setText(state['file_path'])
+
+        if state['context'] == 'file':
+            self.file_text_changes_status = True
+        self.save_status_label.setText('Recovered text that was not saved')
+
+    # What the journal needs to know about the editor text, None when the text is not journaled
+    def describe_journal_text(self):
+        if self.file_loader.is_loading() or self.file_view.is_open() or self.loading_id is not None:
+            return None
+
+        text_option = self.text_list_combobox.currentText()
+        if text_option == 'New':
+            context = 'new'
+        elif text_option == 'File':
+            context = 'file'
+        else:
+            return None
+
+        description = {'context': context, 'title': self.title_entry.text(), 'file_path': self.file_path_entry.text()}
+
+        # An opened file that is not edited yet is journaled as a reference, not as its text
+        if context == 'file' and not self.file_text_changes_status and self.file_base is not None and \
+                self.file_base['file_path'] == description['file_path']:
+            description['base'] = self.file_base
+
+        return description
+
+    def read_file_base(self, file_path):
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        return {'file_path': file_path, 'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
+
+    def fail_database_request(self, name, message):
+        if not self.database_loaded:
+            QMessageBox.critical(self, 'YKPen', 'The database cannot be opened.\n' + message)
+            return
+
+        # Requests that disabled the database widgets, such as a merge, do not get their callback
+        self.set_database_widgets_enabled(True)
+        self.change_poll_pending = False
+
+        if name == 'merge_database_file':
+            self.save_status_label.setText('')
+            QMessageBox.warning(self, 'YKPen', 'The database could not be merged.\n' + message)
+            return
+
+        # A note that could not be read leaves the editor as it was
+        if self.loading_id is not None:
+            self.finish_note_loading()
+        self.inserting_note = False
+
+        self.save_status_label.setText('Database error in {}: {}'.format(name, message))
+
+    # The note list and the database buttons wait for the database
+    def set_database_widgets_enabled(self, enabled):
+        self.text_list_combobox.setEnabled(enabled)
+        self.save_data_button.setEnabled(enabled)
+        self.remove_data_button.setEnabled(enabled)
+        self.backup_database_button.setEnabled(enabled)
+        self.replace_database_button.setEnabled(enabled)
+        self.search_entry.setEnabled(enabled and self.database.search_available)
+
+    @traced()
     def open_file(self):
         default_folder_path = QStandardPaths.writableLocation(QStandardPaths.HomeLocation)
         get_info = QFileDialog.getOpenFileName(self, 'Please choose a file', default_folder_path,
@@ -224,48 +573,142 @@ class YKPen(QWidget):
 
         file_path = get_info[0]
         if file_path != "":
-            self.text_list_combobox.setCurrentText("File")
+            self.open_file_path(file_path)
+
+    @traced()
+    def open_file_path(self, file_path):
+        # The pending edits belong to the note being left, setCurrentText() does not go through load_database()
+        self.auto_save.save()
+        self.shown_id = None
+
+        self.text_list_combobox.setCurrentText("File")
+        self.close_file_view()
+
+        mapped_file = MappedTextFile(file_path)
+
+        windowed = False
+        if mapped_file.size > self.windowed_view_threshold and mapped_file.supports_windows():
+            view_box = QMessageBox()
+            view_box.setText("The file is large.\nDo you want to open it read-only? Only the visible part is loaded.")
+            yes_button = view_box.addButton(QMessageBox.Yes)
+            view_box.addButton(QMessageBox.No)
+            view_box.exec()
+            windowed = view_box.clickedButton() == yes_button
+
+        if windowed:
+            self.editor.setPlainText("")
+            self.editor.hide()
+            self.file_view.show()
+            self.file_view.open(mapped_file)
+        else:
+            # The file is decoded and appended chunk by chunk from the event loop
+            self.file_progress_dialog = QProgressDialog("Opening file...", "Cancel", 0, 1000, self)
+            self.file_progress_dialog.setWindowModality(Qt.WindowModal)
+            self.file_progress_dialog.setMinimumDuration(500)
+            self.file_progress_dialog.canceled.connect(self.cancel_file_loading)
+            self.file_loader.load(mapped_file)
+
+        # The file is written back in the encoding it was read in
+        self.file_encoding = mapped_file.encoding
+
+        file_info = QFileInfo(file_path)
+        title = file_info.completeBaseName()
+        creation_time = file_info.birthTime().toString("yyyy-MM-dd hh:mm:ss")
+        last_modified_time = file_info.lastModified().toString("yyyy-MM-dd hh:mm:ss")
+
+        self.title_entry.setText(title)
+        self.creation_time_label.setText('Created at ' + creation_time)
+        if last_modified_time:
+            self.last_modified_time_label.setText('Last modified at ' + last_modified_time)
+        self.file_path_entry.setText(file_path)
 
-            file = QFile(file_path)
-            file.open(QIODevice.ReadOnly)
-            file_text = QTextStream(file)
-            self.editor.setPlainText(file_text.readAll())
-            file.close()
-
-            file_info = QFileInfo(file_path)
-            title = file_info.completeBaseName()
-            creation_time = file_info.birthTime().toString("yyyy-MM-dd hh:mm:ss")
-            last_modified_time = file_info.lastModified().toString("yyyy-MM-dd hh:mm:ss")
-
-            self.title_entry.setText(title)
-            self.creation_time_label.setText('Created at ' + creation_time)
-            if last_modified_time:
-                self.last_modified_time_label.setText('Last modified at ' + last_modified_time)
-            self.file_path_entry.setText(file_path)
+        self.open_file_status = True
+        self.file_text_changes_status = False
+
+    def show_file_progress(self, loaded_size, file_size):
+        if self.file_progress_dialog is not None:
+            # Sizes are scaled to per mille, byte counts may exceed the int range of the dialog
+            self.file_progress_dialog.setValue(int(loaded_size * 1000 / max(file_size, 1)))
+
+    def close_file_progress(self):
+        if self.file_progress_dialog is not None:
+            self.file_progress_dialog.canceled.disconnect()
+            self.file_progress_dialog.close()
+            self.file_progress_dialog = None
+
+    def finish_file_loading(self):
+        self.close_file_progress()
+        self.file_text_changes_status = False
+        self.file_base = self.read_file_base(self.file_path_entry.text())
+
+    def cancel_file_loading(self):
+        self.file_loader.stop()
+        self.close_file_progress()
 
-            self.open_file_status = True
-            self.file_text_changes_status = False
+        # A partly loaded file must not be saved over the original
+        self.clear_all_contents()
+        self.open_file_status = False
+        self.file_text_changes_status = False
 
-    def read_text_list(self):
-        _, creation_time_list = self.database.read_ids()
-        text_list = creation_time_list
-        text_list.insert(0, "New")
-        text_list.insert(1, "File")
+    def close_file_view(self):
+        if self.file_view.is_open():
+            self.file_view.close_file()
+            self.file_view.hide()
+            self.editor.show()
+
+    # The id of the selected note, None for "New" and "File"
+    def current_id(self):
+        return self.text_list_combobox.currentData(Qt.UserRole)
+
+    # The note list may have to read pages down to the note first, callback runs once it is selected
+    def select_note(self, id_number, callback=None):
+        def select_row(row):
+            if row >= 0:
+                self.text_list_combobox.setCurrentIndex(row)
+            if callback is not None:
+                callback()
+
+        self.note_list_model.load_note(id_number, select_row)
+
+    # Read the note list again and select the open note once its page is back, then run callback. The reset leaves
+    # the selection on "New" until then, so the fields are read-only meanwhile and edits are not taken for a new note.
+    def reload_note_list(self, callback=None):
+        text_option = self.text_list_combobox.currentText()
+        id_number = self.current_id()
 
-        return text_list
+        self.note_list_model.reload()
 
-    def creation_time_to_id(self, creation_time):
-        id_list, creation_time_list = self.database.read_ids()
+        if id_number is None:
+            self.text_list_combobox.setCurrentText(text_option)
+            return
 
-        i = creation_time_list.index(creation_time)
+        self.loading_id = id_number
+        self.title_entry.setReadOnly(True)
+        self.editor.setReadOnly(True)
 
-        id_number = id_list[i]
+        def finish_reload():
+            if self.loading_id == id_number:
+                self.finish_note_loading()
+            if callback is not None:
+                callback()
 
-        return id_number
+        self.select_note(id_number, finish_reload)
 
+    # Select the entry that was chosen again, after a dialog moved the selection away
+    def restore_selection(self, text_option, id_number):
+        if id_number is None:
+            self.text_list_combobox.setCurrentText(text_option)
+        else:
+            self.select_note(id_number)
+
+    @traced()
     def load_database(self):
+        # The pending edits belong to the note being left, they are written before the next note is read
+        self.auto_save.save()
+
         text_option = self.text_list_combobox.currentText()
-        text = self.editor.toPlainText()
+        option_id = self.current_id()
+        text = not self.editor.is_empty()
         current_file_path = self.file_path_entry.text()
 
         if self.new_text_changes_status:
@@ -279,11 +722,11 @@ class YKPen(QWidget):
             exit_box.exec()
             if exit_box.clickedButton() == save_button:
                 self.save_data()
-                self.text_list_combobox.setCurrentText(text_option)
+                self.restore_selection(text_option, option_id)
 
             if exit_box.clickedButton() == discard_button:
                 self.new_text_changes_status = False
-                self.text_list_combobox.setCurrentText(text_option)
+                self.restore_selection(text_option, option_id)
 
             if exit_box.clickedButton() == cancel_button:
                 return
@@ -315,11 +758,11 @@ class YKPen(QWidget):
                     return
                 else:
                     self.file_text_changes_status = False
-                    self.text_list_combobox.setCurrentText(text_option)
+                    self.restore_selection(text_option, option_id)
 
             if exit_box.clickedButton() == discard_button:
                 self.file_text_changes_status = False
-                self.text_list_combobox.setCurrentText(text_option)
+                self.restore_selection(text_option, option_id)
 
             if exit_box.clickedButton() == cancel_button:
                 return
@@ -328,75 +771,164 @@ class YKPen(QWidget):
             self.clear_all_contents()
             self.open_file_status = False
 
-        if text_option != "New" and text_option != "File":
-            id_number = self.creation_time_to_id(text_option)
-            title, text, creation_time, last_modified_time, file_path = self.database.read_record_from_id(id_number)
-
-            self.title_entry.setText(title)
-            self.editor.setPlainText(text)
-            self.creation_time_label.setText('Created at ' + creation_time)
-            if last_modified_time:
-                self.last_modified_time_label.setText('Last modified at ' + last_modified_time)
-            self.file_path_entry.setText(file_path)
+        if option_id is not None:
+            self.close_file_view()
 
-            self.open_file_status = False
+            # Edits made before the note arrives would be taken for edits of it
+            self.loading_id = option_id
+            self.title_entry.setReadOnly(True)
+            self.editor.setReadOnly(True)
+            self.async_database.submit(self.read_note, option_id, callback=self.fill_note)
 
-    def save_file(self):
-        text_option = self.text_list_combobox.currentText()
-        current_file_path = self.file_path_entry.text()
-        if current_file_path != "":
-            file = QFile(current_file_path)
-            file.open(QIODevice.WriteOnly | QIODevice.Truncate)
-            file_text = QTextStream(file)
-            file_text << self.editor.toPlainText()
-            file.close()
-
-            if text_option == 'New':
-                self.new_text_changes_status = False
-            if text_option == 'File':
-                self.file_text_changes_status = False
+    # Runs on the database worker
+    def read_note(self, id_number):
+        return id_number, self.database.read_record_from_id(id_number), self.database.read_text_hash(id_number)
+
+    @traced()
+    def fill_note(self, result):
+        id_number, record, text_hash = result
 
-            file_info = QFileInfo(current_file_path)
-            creation_time = file_info.birthTime().toString("yyyy-MM-dd hh:mm:ss")
-            last_modified_time = file_info.lastModified().toString("yyyy-MM-dd hh:mm:ss")
+        # Another note was chosen meanwhile, its own read comes later
+        if id_number != self.loading_id:
+            return
 
-            self.creation_time_label.setText('Created at ' + creation_time)
-            if last_modified_time:
-                self.last_modified_time_label.setText('Last modified at ' + last_modified_time)
+        self.finish_note_loading()
 
+        if self.current_id() != id_number:
             return
 
-        default_folder_path = QStandardPaths.writableLocation(QStandardPaths.HomeLocation)
-        default_folder = QDir(default_folder_path)
-        title = self.title_entry.text()
-        default_file_path = default_folder.absoluteFilePath(title)
+        title, text, creation_time, last_modified_time, file_path = record
 
-        get_info = QFileDialog.getSaveFileName(self, 'Save as', default_file_path,
-                                               'Text file (*.txt);; HTML file (*.htm);; HTML file (*.html);; '
-                                               'All files (*.*)')
+        self.title_entry.setText(title)
+        self.editor.setPlainText(text)
+        self.creation_time_label.setText('Created at ' + format_time(creation_time))
+        if last_modified_time is not None:
+            self.last_modified_time_label.setText('Last modified at ' + format_time(last_modified_time, False))
+        self.file_path_entry.setText(file_path)
 
-        file_path = get_info[0]
-        if file_path != '':
-            file = QFile(file_path)
-            file.open(QIODevice.WriteOnly | QIODevice.Truncate)
-            file_text = QTextStream(file)
-            file_text << self.editor.toPlainText()
-            file.close()
+        # Filling in the fields is not an edit
+        self.auto_save.discard()
+        self.shown_id = id_number
+        self.saved_fields = (id_number, title, file_path)
+        self.saved_text_hash = text_hash
+
+        self.open_file_status = False
+
+        # The notes next to this one in the list are the likely next ones, they are read into the record cache
+        self.async_database.submit(self.database.prefetch_records, self.note_list_model.neighbour_ids(id_number))
+
+    def finish_note_loading(self):
+        self.loading_id = None
+        self.title_entry.setReadOnly(False)
+        self.editor.setReadOnly(False)
+
+    @traced()
+    def save_file(self, background=False):
+        # The windowed view is read-only and the editor does not hold the file
+        if self.file_view.is_open() or self.file_loader.is_loading() or self.file_save_task is not None:
+            return
+
+        text_option = self.text_list_combobox.currentText()
+        file_path = self.file_path_entry.text()
+
+        if file_path == "":
+            default_folder_path = QStandardPaths.writableLocation(QStandardPaths.HomeLocation)
+            default_folder = QDir(default_folder_path)
+            title = self.title_entry.text()
+            default_file_path = default_folder.absoluteFilePath(title)
+
+            get_info = QFileDialog.getSaveFileName(self, 'Save as', default_file_path,
+                                                   'Text file (*.txt);; HTML file (*.htm);; HTML file (*.html);; '
+                                                   'All files (*.*)')
+
+            file_path = get_info[0]
+            if file_path == '':
+                return
 
+        self.file_save_option = text_option
+        self.start_file_saving(file_path, background)
+
+    def start_file_saving(self, file_path, background):
+        text = self.editor.toPlainText()
+
+        self.file_save_revision = self.editor.edit_tracker.revision
+
+        self.file_save_task = FileSaveTask(file_path, text, self.file_encoding)
+        self.file_save_task.finished.connect(self.finish_file_saving)
+        self.file_save_task.failed.connect(self.fail_file_saving)
+        self.file_save_task.unencodable.connect(self.ask_file_encoding)
+
+        # Small documents are saved right away, the handlers run before save_file returns
+        if background and len(text) > self.background_save_threshold:
+            self.save_status_label.setText('Saving...')
+            self.file_save_task.start()
+        else:
+            self.file_save_task.run()
+
+    def save_file_clicked(self):
+        self.save_file(background=True)
+
+    def finish_file_saving(self, file_path, written_size, duration):
+        self.file_save_task = None
+
+        if self.file_path_entry.text() != file_path:
             self.file_path_entry.setText(file_path)
 
-            if text_option == 'New':
+        # Edits made while a large document was being written still need saving
+        if self.editor.edit_tracker.revision == self.file_save_revision:
+            if self.file_save_option == 'New':
                 self.new_text_changes_status = False
-            if text_option == 'File':
+            if self.file_save_option == 'File':
                 self.file_text_changes_status = False
 
-            file_info = QFileInfo(file_path)
-            creation_time = file_info.birthTime().toString("yyyy-MM-dd hh:mm:ss")
-            last_modified_time = file_info.lastModified().toString("yyyy-MM-dd hh:mm:ss")
-            self.creation_time_label.setText('Created at ' + creation_time)
-            if last_modified_time:
-                self.last_modified_time_label.setText('Last modified at ' + last_modified_time)
+            # The journal starts over from the saved file with the next edit
+            self.file_base = self.read_file_base(file_path)
+            self.journal.mark_clean()
+
+        if written_size:
+            self.save_status_label.setText('Saved {} bytes in {:.0f} ms'.format(written_size, duration * 1000))
+        else:
+            self.save_status_label.setText('Unchanged, not written')
+
+        file_info = QFileInfo(file_path)
+        creation_time = file_info.birthTime().toString("yyyy-MM-dd hh:mm:ss")
+        last_modified_time = file_info.lastModified().toString("yyyy-MM-dd hh:mm:ss")
+
+        self.creation_time_label.setText('Created at ' + creation_time)
+        if last_modified_time:
+            self.last_modified_time_label.setText('Last modified at ' + last_modified_time)
+
+    # The file was read in an encoding that cannot hold the text, it is only written in UTF-8 if the user agrees
+    def ask_file_encoding(self, error):
+        if self.file_encoding == 'utf-8':
+            self.fail_file_saving(error)
+            return
+
+        file_path = self.file_save_task.file_path
+        background = self.file_save_task.thread is not None
+        self.file_save_task = None
+        self.save_status_label.setText('')
+
+        encoding_box = QMessageBox()
+        encoding_box.setText("The text has characters that the file's encoding ({}) cannot hold.\n"
+                             "Do you want to save the file as UTF-8?".format(self.file_encoding))
+        yes_button = encoding_box.addButton(QMessageBox.Yes)
+        encoding_box.addButton(QMessageBox.No)
+        encoding_box.exec()
+
+        if encoding_box.clickedButton() == yes_button:
+            self.file_encoding = 'utf-8'
+            self.start_file_saving(file_path, background)
+
+    def fail_file_saving(self, error):
+        self.file_save_task = None
+        self.save_status_label.setText('')
 
+        error_box = QMessageBox()
+        error_box.setText("The file could not be saved.\n" + error)
+        error_box.exec()
+
+    @traced()
     def save_data(self):
         text_option = self.text_list_combobox.currentText()
 
@@ -405,44 +937,97 @@ class YKPen(QWidget):
             return
 
         title = self.title_entry.text()
-        text = self.editor.toPlainText()
 
-        if not title and not text:
+        # Edits made until the id arrives are written by the autosave afterwards
+        if self.inserting_note or (not title and self.editor.is_empty()):
             return
 
-        current_time = QDateTime.currentDateTime()
-        creation_time = current_time.toString("yyyy-MM-dd hh:mm:ss")
-        last_modified_time = ""
+        text = self.editor.toPlainText()
+        text_hash = self.editor.edit_tracker.content_digest(text)
+        self.editor.edit_tracker.mark_saved()
+
+        # Times are stored as epoch milliseconds, which also keeps creation times unique
+        creation_time = QDateTime.currentMSecsSinceEpoch()
         file_path = self.file_path_entry.text()
 
-        self.database.insert_record(title, text, creation_time, last_modified_time, file_path)
+        self.inserting_note = True
+        self.new_text_changes_status = False
+
+        self.async_database.insert_record(
+            title, text, creation_time, None, file_path,
+            callback=lambda id_number: self.finish_note_insert(id_number, title, text_hash, creation_time, file_path))
+
+    def finish_note_insert(self, id_number, title, text_hash, creation_time, file_path):
+        self.inserting_note = False
 
+        row = self.note_list_model.add_note(id_number, creation_time)
+
+        # The new note is only selected if nothing else was chosen meanwhile
+        if self.text_list_combobox.currentText() != 'New':
+            return
+
+        # The list is being reloaded, the note is selected once its page is there
+        if row >= 0:
+            self.text_list_combobox.setCurrentIndex(row)
+        else:
+            self.select_note(id_number)
+        self.creation_time_label.setText('Created at ' + format_time(creation_time))
         self.new_text_changes_status = False
 
-        text_list = self.read_text_list()
+        # The text is in the database now, a crash must not offer it for recovery again
+        self.journal.mark_clean()
 
-        self.text_list_combobox.clear()
-        self.text_list_combobox.addItems(text_list)
-        self.text_list_combobox.setEditable(False)
-        self.text_list_combobox.setCurrentText(creation_time)
-        self.creation_time_label.setText('Created at ' + creation_time)
+        self.shown_id = id_number
+        self.saved_fields = (id_number, title, file_path)
+        self.saved_text_hash = text_hash
+        self.auto_save.schedule(id_number)
+
+    @traced()
+    def read_update_snapshot(self, id_number):
+        # The fields hold another note or a file by now, they must not be written over this one. The selection
+        # itself has moved on already when load_database() writes the edits of the note being left.
+        if id_number != self.shown_id:
+            return None
 
-    def update_data(self):
-        text_option = self.text_list_combobox.currentText()
-        id_number = self.creation_time_to_id(text_option)
         title = self.title_entry.text()
-        text = self.editor.toPlainText()
-        current_time = QDateTime.currentDateTime()
-        last_modified_time = current_time.toString("yyyy-MM-dd hh:mm:ss")
         file_path = self.file_path_entry.text()
 
-        self.last_modified_time_label.setText('Last modified at ' + last_modified_time)
+        # Nothing to write if neither the fields nor the document changed since the last write
+        if not self.editor.edit_tracker.is_modified() and self.saved_fields == (id_number, title, file_path):
+            return None
+
+        with span('Editor.toPlainText'):
+            text = self.editor.toPlainText()
+        text_hash = self.editor.edit_tracker.content_digest(text)
+        self.editor.edit_tracker.mark_saved()
+
+        # Edits that were undone leave the stored text, which the hashes show without reading it back
+        if self.saved_fields == (id_number, title, file_path) and self.saved_text_hash == text_hash:
+            return None
+
+        self.saved_fields = (id_number, title, file_path)
+        self.saved_text_hash = text_hash
+
+        last_modified_time = QDateTime.currentMSecsSinceEpoch()
 
-        self.database.update_record_from_id(id_number, title, text, last_modified_time, file_path)
+        self.last_modified_time_label.setText('Last modified at ' + format_time(last_modified_time, False))
 
+        return id_number, title, text, last_modified_time, file_path
+
+    def update_data(self):
+        id_number = self.current_id()
+
+        self.auto_save.schedule(id_number)
+        self.auto_save.save()
+
+    @traced()
     def auto_save_data(self):
+        # Chunks of a file being opened and the fields of a note being read are not edits
+        if self.file_loader.is_loading() or self.loading_id is not None:
+            return
+
         title = self.title_entry.text()
-        text = self.editor.toPlainText()
+        text = not self.editor.is_empty()
 
         text_option = self.text_list_combobox.currentText()
 
@@ -466,39 +1051,172 @@ class YKPen(QWidget):
             self.save_data()
 
         if text_option != "New" and text_option != 'File':
-            self.update_data()
+            self.auto_save.schedule(self.current_id())
 
+    @traced()
     def remove_data(self):
         text_option = self.text_list_combobox.currentText()
 
         if text_option != "New" and text_option != "File":
-            id_number = self.creation_time_to_id(text_option)
-            self.database.remove_record_from_id(id_number)
+            id_number = self.current_id()
+            self.auto_save.discard()
+            self.async_database.remove_record_from_id(id_number)
 
-            text_list = self.read_text_list()
-            self.text_list_combobox.clear()
-            self.text_list_combobox.addItems(text_list)
-            self.text_list_combobox.setEditable(False)
+            self.note_list_model.remove_note(id_number)
             self.text_list_combobox.setCurrentText("New")
 
             self.clear_all_contents()
 
+    # Ask the worker for the notes other windows and processes wrote since the last poll, one request at a time
+    def poll_changes(self):
+        if not self.database_loaded or self.change_poll_pending:
+            return
+
+        self.change_poll_pending = True
+        self.async_database.submit(self.database.read_changes, callback=self.apply_changes)
+
+    # Only the changed entries of the list are touched. The open note is read again if it changed elsewhere and
+    # has no edits of its own, otherwise the next autosave writes over the change.
+    @traced()
+    def apply_changes(self, result):
+        self.change_poll_pending = False
+        if result is None:
+            return
+
+        reload, changes = result
+        open_id = self.current_id()
+
+        if reload:
+            self.reload_note_list(lambda: self.refresh_open_note(open_id, None, None, True))
+            return
+
+        for id_number, creation_time, title, text_hash in changes:
+            if creation_time is None and title is None and text_hash is None:
+                self.note_list_model.remove_note(id_number)
+                if id_number == open_id:
+                    self.auto_save.discard()
+                    self.text_list_combobox.setCurrentText('New')
+                    self.clear_all_contents()
+                    self.save_status_label.setText('The note was removed in another window')
+            else:
+                self.note_list_model.add_note(id_number, creation_time)
+                if id_number == open_id:
+                    self.refresh_open_note(id_number, title, text_hash)
+
+    def refresh_open_note(self, id_number, title, text_hash, force=False):
+        if self.current_id() != id_number or self.loading_id is not None:
+            return
+
+        # The write of this window itself
+        if not force and self.saved_fields is not None and self.saved_fields[1] == title and \
+                self.saved_text_hash == text_hash:
+            return
+
+        if self.auto_save.is_pending() or self.editor.edit_tracker.is_modified():
+            self.save_status_label.setText('The note was changed in another window, your edits are kept')
+            return
+
+        self.loading_id = id_number
+        self.title_entry.setReadOnly(True)
+        self.editor.setReadOnly(True)
+        self.async_database.submit(self.read_note, id_number, callback=self.fill_note)
+
+    # Earlier versions of the open note, kept by the database as revisions
+    def show_history(self):
+        id_number = self.current_id()
+        if not self.database_loaded or id_number is None:
+            return
+
+        # The edits so far are written first, the text they replace becomes the newest revision
+        self.auto_save.save()
+        self.async_database.read_revisions(
+            id_number, callback=lambda revisions: self.choose_revision(id_number, revisions))
+
+    def choose_revision(self, id_number, revisions):
+        if self.current_id() != id_number:
+            return
+
+        if not revisions:
+            self.save_status_label.setText('There are no earlier versions of this note')
+            return
+
+        labels = ['{}    {} characters'.format(format_time(time, False), size) for _, time, size in revisions]
+        label, accepted = QInputDialog.getItem(self, 'History', 'Restore the version of:', labels, 0, False)
+        if not accepted or self.current_id() != id_number:
+            return
+
+        revision_id = revisions[labels.index(label)][0]
+        self.async_database.read_revision(revision_id, callback=lambda text: self.restore_revision(id_number, text))
+
+    # The restored text replaces the editor text as one edit, which can be undone and is autosaved like any other
+    def restore_revision(self, id_number, text):
+        if self.current_id() != id_number or self.loading_id is not None or text is None:
+            return
+
+        cursor = QTextCursor(self.editor.document())
+        cursor.select(QTextCursor.Document)
+        cursor.insertText(text)
+
+    @traced()
     def backup_database(self):
         default_folder_path = QStandardPaths.writableLocation(QStandardPaths.HomeLocation)
         default_folder = QDir(default_folder_path)
         backup_db_name = "YKPen_database_backup"
         default_file_path = default_folder.absoluteFilePath(backup_db_name)
 
-        get_info = QFileDialog.getSaveFileName(self, 'Save as', default_file_path, 'SQLite database (*.db)')
+        compressed_filter = 'Compressed SQLite database (*.db.gz)'
+        get_info = QFileDialog.getSaveFileName(self, 'Save as', default_file_path,
+                                               'SQLite database (*.db);; ' + compressed_filter)
 
         file_path = get_info[0]
-        if file_path != "":
-            if QFile.exists(file_path):
-                QFile.remove(file_path)
+        if file_path != "" and self.backup_task is None:
+            compress = get_info[1] == compressed_filter or file_path.endswith('.gz')
+            if compress and file_path.endswith('.gz'):
+                file_path = file_path[:-3]
 
             database_path = self.commands.read_database_path()
-            QFile.copy(database_path, file_path)
 
+            # The copy runs on its own thread, page by page, while the window stays usable
+            self.backup_progress_dialog = QProgressDialog("Backing up database...", "Cancel", 0, 100, self)
+            self.backup_progress_dialog.setWindowModality(Qt.WindowModal)
+            self.backup_progress_dialog.setMinimumDuration(500)
+
+            self.backup_task = BackupTask(database_path, file_path, compress)
+            self.backup_task.progress.connect(self.show_backup_progress)
+            self.backup_task.finished.connect(self.finish_backup)
+            self.backup_task.cancelled.connect(self.finish_backup)
+            self.backup_task.failed.connect(self.fail_backup)
+            self.backup_progress_dialog.canceled.connect(self.backup_task.cancel)
+
+            # The pending edits and the writes handed to the worker go into the copy
+            self.auto_save.save()
+            self.async_database.when_idle(lambda result: self.start_backup())
+
+    def start_backup(self):
+        if self.backup_task is not None:
+            self.backup_task.start()
+
+    def show_backup_progress(self, copied_pages, total_pages):
+        if self.backup_progress_dialog is not None:
+            self.backup_progress_dialog.setMaximum(total_pages)
+            self.backup_progress_dialog.setValue(copied_pages)
+
+    def finish_backup(self, target_path=None):
+        if self.backup_progress_dialog is not None:
+            self.backup_progress_dialog.canceled.disconnect()
+            self.backup_progress_dialog.close()
+
+        self.backup_progress_dialog = None
+        self.backup_task = None
+
+    def fail_backup(self, error):
+        self.finish_backup()
+
+        error_box = QMessageBox()
+        error_box.setText("The database could not be backed up.\n" + error)
+        error_box.exec()
+
+    @traced()
     def replace_database(self):
         default_folder_path = QStandardPaths.writableLocation(QStandardPaths.HomeLocation)
         get_info = QFileDialog.getOpenFileName(self, 'Please choose a file', default_folder_path,
@@ -506,22 +1224,142 @@ class YKPen(QWidget):
 
         file_path = get_info[0]
         if file_path != "":
+            choice_box = QMessageBox()
+            choice_box.setText("Do you want to merge the notes of this database into the default database, or replace "
+                               "the default database with it?")
+            merge_button = choice_box.addButton('Merge', QMessageBox.AcceptRole)
+            replace_button = choice_box.addButton('Replace', QMessageBox.DestructiveRole)
+            choice_box.addButton(QMessageBox.Cancel)
+            choice_box.exec()
+            if choice_box.clickedButton() == merge_button:
+                self.merge_database(file_path)
+                return
+            if choice_box.clickedButton() != replace_button:
+                return
+
             exit_box = QMessageBox()
             exit_box.setText("Are you sure you want to replace database? Data in default database will be lost.")
             yes_button = exit_box.addButton(QMessageBox.Yes)
             no_button = exit_box.addButton(QMessageBox.No)
             exit_box.exec()
             if exit_box.clickedButton() == yes_button:
-                database_path = self.commands.read_database_path()
-                QFile.remove(database_path)
-                QFile.copy(file_path, database_path)
+                # The pending edits still go into the database being replaced, the swap comes after them
+                self.auto_save.save()
+
+                # The open note belongs to the database being replaced
+                if self.current_id() is not None:
+                    self.auto_save.discard()
+                    self.clear_all_contents()
+
+                # The replacement may come from an older version, it is upgraded on the worker as at startup. The
+                # list waits for it, a page read now would come from the database being replaced.
+                self.note_list_model.wait_for_database()
+                self.note_list_model.reload()
+                self.text_list_combobox.setCurrentIndex(0)
+
+                self.database_loaded = False
+                self.set_database_widgets_enabled(False)
+                self.async_database.submit(self.swap_database_file, file_path, callback=self.finish_swap)
+
+    # Runs on the database worker. The file is copied into the open database, which is left as it was if that fails.
+    def swap_database_file(self, file_path):
+        try:
+            restore_database(file_path, self.database)
+        except (RestoreError, OSError, sqlite3.Error) as error:
+            return self.prepare_database(), str(error)
+
+        return self.prepare_database(), None
+
+    def finish_swap(self, result):
+        page, error = result
+        self.finish_startup(page)
+
+        if error is not None:
+            QMessageBox.warning(self, 'YKPen', 'The database could not be replaced.\n' + error)
+
+    def merge_database(self, file_path):
+        labels = [merge_modes[mode] for mode in ('newest', 'both', 'skip')]
+        label, accepted = QInputDialog.getItem(self, 'Merge database', 'Notes created at the same time as a note '
+                                               'here, but with another text:', labels, 0, False)
+        if not accepted:
+            return
+        mode = ('newest', 'both', 'skip')[labels.index(label)]
+
+        # The pending edits are written first, the merge may update the note being edited
+        self.auto_save.save()
+        self.set_database_widgets_enabled(False)
+
+        merger = Merger(self.database, mode)
+        self.async_database.submit(self.merge_database_file, merger, file_path, callback=self.finish_merge)
+
+    # Runs on the database worker
+    def merge_database_file(self, merger, file_path):
+        merger.run(file_path, self.merge_progress.emit)
+        return merger.describe()
 
-                text_list = self.read_text_list()
-                self.text_list_combobox.clear()
-                self.text_list_combobox.addItems(text_list)
-                self.text_list_combobox.setEditable(False)
+    def show_merge_progress(self, step, done, total):
+        self.save_status_label.setText('Merging database: {} {}/{}'.format(step, done, total))
+
+    def finish_merge(self, summary):
+        self.save_status_label.setText(summary)
+        self.set_database_widgets_enabled(True)
+
+        # The list is read again, and the open note in case the merge changed it
+        self.reload_note_list(self.load_database)
+
+    @traced()
+    def search_data(self):
+        query = self.search_entry.text()
+
+        self.async_database.search(query, callback=lambda results: self.show_search_results(query, results))
+
+    def show_search_results(self, query, results):
+        # The query changed while it was searched, its own results follow
+        if query != self.search_entry.text():
+            return
+
+        self.search_results_list.clear()
+
+        if not results:
+            self.search_results_list.hide()
+            return
+
+        for id_number, creation_time, title, text in results:
+            title = title or ''
+            text = text or ''
+            item = QListWidgetItem(format_time(creation_time) + '    ' + title + '    ' + text.replace('\n', ' '))
+            item.setData(Qt.UserRole, id_number)
+            self.search_results_list.addItem(item)
+
+        self.search_results_list.show()
+
+    def open_search_result(self, item):
+        id_number = item.data(Qt.UserRole)
+
+        self.select_note(id_number, self.load_database)
+
+    def run_maintenance(self):
+        if not self.database_loaded or self.auto_save.is_pending():
+            return
+
+        if self.maintenance_future is not None and not self.maintenance_future.done():
+            return
+
+        if self.maintenance.is_full_run_active():
+            return
+
+        self.maintenance_future = self.async_database.submit(self.maintenance.run_idle,
+                                                             callback=self.start_full_maintenance)
+
+    # VACUUM runs on a thread of its own, the worker stays free for the requests of the window
+    def start_full_maintenance(self, due):
+        if due:
+            self.maintenance.start_full_run()
 
     def open_settings(self):
+        if self.settings_panel is None:
+            self.settings_panel = Settings()
+
         x = self.geometry().x()
         y = self.geometry().y()
         width = self.geometry().width()
@@ -529,6 +1367,11 @@ class YKPen(QWidget):
         self.settings_panel.show()
 
     def clear_all_contents(self):
+        self.shown_id = None
+        self.close_file_view()
+        self.file_encoding = 'utf-8'
+        self.file_base = None
+        self.save_status_label.setText("")
         self.title_entry.setText("")
         self.editor.setPlainText("")
         self.creation_time_label.setText("")
@@ -575,13 +1418,29 @@ class YKPen(QWidget):
             event.ignore()
 
     def closeEvent(self, event):
+        # A write that failed, such as on a locked database or a full disk, keeps the window open with the edits
+        try:
+            self.auto_save.flush()
+        except (sqlite3.Error, OSError) as error:
+            self.save_status_label.setText('Database error in update_record_from_id: {}'.format(error))
+            QMessageBox.warning(self, 'YKPen', 'The last edits could not be saved.\n' + str(error))
+
+            # The snapshot counted as written, the next close tries it again
+            if self.shown_id is not None:
+                self.saved_fields = None
+                self.saved_text_hash = None
+                self.auto_save.schedule(self.shown_id)
+
+            event.ignore()
+            return
+
         text_option = self.text_list_combobox.currentText()
 
         if text_option == "New" and self.new_text_changes_status:
             self.handle_new_text_changes(event)
             return
 
-        text = self.editor.toPlainText()
+        text = not self.editor.is_empty()
         creation_time = self.creation_time_label.text()
         if text_option == "File" and text and not creation_time:
             self.file_text_changes_status = True
@@ -593,7 +1452,24 @@ class YKPen(QWidget):
 
 
 if __name__ == '__main__':
-    app = QApplication([])
-    main_window = YKPen()
+    # --profile-startup prints the time of each startup phase
+    startup_profile = None
+    if '--profile-startup' in sys.argv:
+        sys.argv.remove('--profile-startup')
+        startup_profile = StartupProfile(startup_time)
+        startup_profile.mark('imports')
+
+    app = QApplication(sys.argv)
+    if startup_profile is not None:
+        startup_profile.mark('application')
+
+    main_window = YKPen(startup_profile)
+    app.aboutToQuit.connect(main_window.change_timer.stop)
+    app.aboutToQuit.connect(main_window.maintenance_timer.stop)
+    app.aboutToQuit.connect(main_window.maintenance.stop)
+    app.aboutToQuit.connect(main_window.auto_save.shutdown)
+    app.aboutToQuit.connect(main_window.async_database.shutdown)
+    app.aboutToQuit.connect(main_window.database.close_db)
+    app.aboutToQuit.connect(main_window.journal.close)
     main_window.show()
     sys.exit(app.exec())
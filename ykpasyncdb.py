@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+
+
+class AsyncDatabase(QObject):
+    # Results are handed to the UI thread through delivered, the callbacks run there
+    delivered = Signal(object, object)
+    failed = Signal(str, str)
+
+    def __init__(self, database):
+        super(AsyncDatabase, self).__init__()
+
+        self.database = database
+
+        # A single worker runs the requests in the order they were made, so requests for the same note never
+        # overtake each other and a read sees every write requested before it
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='YKPenDatabase')
+
+        self.delivered.connect(self.deliver)
+
+    # Run function(*arguments) on the worker and return its future. callback, if given, gets the result on the UI
+    # thread, errors are reported through failed.
+    def submit(self, function, *arguments, callback=None):
+        future = self.executor.submit(function, *arguments)
+        future.add_done_callback(lambda done_future: self.finish(function, done_future, callback))
+        return future
+
+    # Runs on the worker thread
+    def finish(self, function, future, callback):
+        if future.cancelled():
+            return
+
+        error = future.exception()
+        if error is not None:
+            self.failed.emit(getattr(function, '__name__', 'request'), str(error))
+        elif callback is not None:
+            self.delivered.emit(callback, future.result())
+
+    def deliver(self, callback, result):
+        callback(result)
+
+    def read_record_from_id(self, id_number, callback=None):
+        return self.submit(self.database.read_record_from_id, id_number, callback=callback)
+
+    def insert_record(self, title, text, creation_time, last_modified_time, file_path, callback=None):
+        return self.submit(self.database.insert_record, title, text, creation_time, last_modified_time, file_path,
+                           callback=callback)
+
+    def update_record_from_id(self, id_number, title, text, last_modified_time, file_path, callback=None):
+        return self.submit(self.database.update_record_from_id, id_number, title, text, last_modified_time,
+                           file_path, callback=callback)
+
+    def read_ids(self, callback=None):
+        return self.submit(self.database.read_ids, callback=callback)
+
+    def read_ids_page(self, before_id=None, limit=200, callback=None):
+        return self.submit(self.database.read_ids_page, before_id, limit, callback=callback)
+
+    def remove_record_from_id(self, id_number, callback=None):
+        return self.submit(self.database.remove_record_from_id, id_number, callback=callback)
+
+    def search(self, query, callback=None):
+        return self.submit(self.database.search, query, callback=callback)
+
+    def read_revisions(self, id_number, callback=None):
+        return self.submit(self.database.read_revisions, id_number, callback=callback)
+
+    def read_revision(self, revision_id, callback=None):
+        return self.submit(self.database.read_revision, revision_id, callback=callback)
+
+    # callback runs on the UI thread once the requests made so far are done
+    def when_idle(self, callback):
+        return self.submit(lambda: None, callback=callback)
+
+    # Block until the requests made so far are done
+    def wait(self):
+        self.executor.submit(lambda: None).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,80 @@
+from PySide6.QtCore import QObject, QTimer
+
+
+class AutoSave(QObject):
+    def __init__(self, snapshot_function, write_function, worker, idle_interval=1000, max_latency=5000):
+        super(AutoSave, self).__init__()
+
+        # snapshot_function runs on the UI thread and returns the arguments of write_function,
+        # write_function runs on the worker thread
+        self.snapshot_function = snapshot_function
+        self.write_function = write_function
+
+        # The worker is shared with the other database requests (AsyncDatabase), it runs everything in the order it
+        # was handed over, so a read made after save() sees the write
+        self.worker = worker
+
+        self.pending_key = None
+        self.running_future = None
+
+        # Written once the edits pause for idle_interval, or at the latest max_latency after the first edit
+        self.idle_timer = QTimer()
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(idle_interval)
+        self.idle_timer.timeout.connect(self.save)
+
+        self.latency_timer = QTimer()
+        self.latency_timer.setSingleShot(True)
+        self.latency_timer.setInterval(max_latency)
+        self.latency_timer.timeout.connect(self.save)
+
+    def is_pending(self):
+        return self.pending_key is not None
+
+    def schedule(self, key):
+        if self.pending_key is not None and self.pending_key != key:
+            self.save()
+
+        self.pending_key = key
+        self.idle_timer.start()
+        if not self.latency_timer.isActive():
+            self.latency_timer.start()
+
+    def stop_timers(self):
+        self.idle_timer.stop()
+        self.latency_timer.stop()
+
+    # Take a snapshot of the pending edits and hand it to the worker
+    def save(self):
+        self.stop_timers()
+
+        key = self.pending_key
+        self.pending_key = None
+        if key is None:
+            return
+
+        arguments = self.snapshot_function(key)
+        if arguments is None:
+            return
+
+        self.running_future = self.worker.submit(self.write_function, *arguments)
+
+    # Wait for the write in progress, errors of the worker are raised here
+    def wait(self):
+        future = self.running_future
+        self.running_future = None
+        if future is not None:
+            future.result()
+
+    # Write the pending edits and return once they are in the database
+    def flush(self):
+        self.save()
+        self.wait()
+
+    # Drop the pending edits without writing them, writes already handed over still go in before later requests
+    def discard(self):
+        self.stop_timers()
+        self.pending_key = None
+
+    def shutdown(self):
+        self.flush()
@@ -0,0 +1,176 @@
+import os
+import sys
+import gzip
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+from ykpdatabase import BasicConfig, Database
+from ykptrace import traced, count
+
+
+class BackupCancelled(Exception):
+    pass
+
+
+class RestoreError(Exception):
+    pass
+
+
+# Copy a live database page by page with the SQLite backup API, the copy is consistent even while it is written to.
+# Returns the path of the backup and its size in bytes.
+@traced()
+def backup_database(source_path, target_path, pages=256, progress=None, cancel_event=None, compress=False):
+    if compress and not target_path.endswith('.gz'):
+        target_path = target_path + '.gz'
+
+    part_path = target_path + '.part'
+    if compress:
+        copy_path = target_path + '.db.part'
+    else:
+        copy_path = part_path
+
+    def report(status, remaining, total):
+        if cancel_event is not None and cancel_event.is_set():
+            raise BackupCancelled()
+        if progress is not None:
+            progress(total - remaining, total)
+
+    source_db = sqlite3.connect(source_path)
+    target_db = sqlite3.connect(copy_path)
+    try:
+        source_db.backup(target_db, pages=pages, progress=report)
+        target_db.close()
+
+        if compress:
+            with open(copy_path, 'rb') as copy_file, gzip.open(part_path, 'wb') as part_file:
+                shutil.copyfileobj(copy_file, part_file, 1024 * 1024)
+            os.remove(copy_path)
+
+        os.replace(part_path, target_path)
+    except BaseException:
+        target_db.close()
+        for path in (copy_path, part_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        source_db.close()
+
+    size = os.path.getsize(target_path)
+    count(bytes=size)
+
+    return target_path, size
+
+
+# Copy the database of source_db to copy_path with pages of page_size bytes. The page size of a database only changes
+# through VACUUM and not in WAL mode, which the copy takes over from a source in WAL mode.
+def copy_with_page_size(source_db, copy_path, page_size):
+    copy_db = sqlite3.connect(copy_path)
+    try:
+        source_db.backup(copy_db)
+        copy_db.execute('PRAGMA journal_mode = DELETE')
+        copy_db.execute('PRAGMA page_size = {}'.format(int(page_size)))
+        copy_db.execute('VACUUM')
+    except BaseException:
+        copy_db.close()
+        raise
+
+    return copy_db
+
+
+# Replace the contents of the live database with those of the file at source_path, through the SQLite backup API.
+# The copy is one write transaction of the open database, so other windows and processes see it like any other write,
+# while swapping the file itself would leave them on the old one. The file must pass quick_check, be a YKPen
+# database and not come from a newer version, older ones are upgraded afterwards.
+@traced()
+def restore_database(source_path, database):
+    if not os.path.isfile(source_path):
+        raise RestoreError('No such file: ' + source_path)
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        source_db = sqlite3.connect(source_path)
+        try:
+            try:
+                result = [row[0] for row in source_db.execute('PRAGMA quick_check')]
+            except sqlite3.DatabaseError as error:
+                raise RestoreError('The file cannot be read as a database: ' + str(error))
+            if result != ['ok']:
+                raise RestoreError('The database is damaged: ' + '; '.join(result[:5]))
+
+            data_table = source_db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'data'")
+            if data_table.fetchone() is None:
+                raise RestoreError('Not a YKPen database: ' + source_path)
+
+            if source_db.execute('PRAGMA user_version').fetchone()[0] > len(Database.migrations):
+                raise RestoreError('The database comes from a newer version of YKPen')
+
+            # The backup API cannot change the page size of a database in WAL mode, a source with other pages is
+            # restored from a copy rebuilt with those of the live database
+            page_size = database.open_db().execute('PRAGMA page_size').fetchone()[0]
+            if source_db.execute('PRAGMA page_size').fetchone()[0] != page_size:
+                copy_db = copy_with_page_size(source_db, os.path.join(folder_path, 'restore.db'), page_size)
+                source_db.close()
+                source_db = copy_db
+
+                if source_db.execute('PRAGMA page_size').fetchone()[0] != page_size:
+                    raise RestoreError('The pages of the database cannot be converted to {} bytes'.format(page_size))
+
+            with database.transaction() as db_cursor:
+                db_cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM changes')
+                change_seq = db_cursor.fetchone()[0]
+
+            # The backup fails if another connection writes meanwhile
+            source_db.backup(database.open_db())
+        finally:
+            source_db.close()
+
+    database.record_cache.clear()
+    database.initialize_db()
+    database.restart_changes(change_seq)
+
+    count(bytes=os.path.getsize(source_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Back up YKPen databases')
+    parser.add_argument('profile_folders', nargs='*',
+                        help='profile folders to back up, the profile folder of this user by default')
+    parser.add_argument('--output', required=True, help='folder the backups are written to')
+    parser.add_argument('--compress', action='store_true', help='write gzip compressed backups')
+    parser.add_argument('--pages', type=int, default=256, help='pages copied per step')
+    args = parser.parse_args()
+
+    profile_folders = args.profile_folders or [BasicConfig.read_profile_folder_path()]
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+
+    os.makedirs(args.output, exist_ok=True)
+
+    status = 0
+    for profile_folder in profile_folders:
+        source_path = os.path.join(profile_folder, 'YKPen_database.db')
+        if not os.path.exists(source_path):
+            print('{}: no database'.format(profile_folder), file=sys.stderr)
+            status = 1
+            continue
+
+        folder_name = os.path.basename(os.path.normpath(profile_folder))
+        target_path = os.path.join(args.output, '{}-YKPen_database-{}.db'.format(folder_name, timestamp))
+
+        start = time.perf_counter()
+        try:
+            target_path, size = backup_database(source_path, target_path, pages=args.pages, compress=args.compress)
+        except (OSError, sqlite3.Error) as error:
+            print('{}: {}'.format(profile_folder, error), file=sys.stderr)
+            status = 1
+            continue
+
+        print('{} -> {} ({} bytes, {:.2f} s)'.format(source_path, target_path, size, time.perf_counter() - start))
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,786 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import platform
+import shutil
+import argparse
+import itertools
+import multiprocessing
+import tempfile
+
+from ykpdatabase import BasicConfig, Database, hash_text
+from ykpmerge import Merger, merge_modes
+
+words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet', 'kilo', 'lima',
+         'mike', 'november', 'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango', 'uniform', 'victor', 'whiskey',
+         'xray', 'yankee', 'zulu', 'note', 'draft', 'meeting', 'budget', 'report', 'review', 'release', 'backup']
+
+
+def create_database(db_path, notes, text_size):
+    database = Database(db_path)
+    current_time = int(time.time() * 1000)
+
+    with database.transaction(write=True) as db_cursor:
+        text_hash, size = database.write_blob(db_cursor, 'x' * text_size)
+        db_cursor.executemany(
+            'INSERT INTO data (title, text_hash, creation_time, last_modified_time, file_path, size) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (('Note ' + str(i), text_hash, current_time + i, None, '', size) for i in range(notes))
+        )
+        database.index_notes_after(db_cursor, 0)
+
+    return database
+
+
+# A database as the app created it before connections were kept open, in rollback journal mode
+def create_legacy_database(db_path, notes, text_size):
+    db = sqlite3.connect(db_path)
+    db_cursor = db.cursor()
+    db_cursor.execute('CREATE TABLE IF NOT EXISTS data (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                      'title, text, creation_time, last_modified_time, file_path)')
+    current_time = time.strftime('%Y-%m-%d %H:%M:%S')
+    db_cursor.executemany(
+        'INSERT INTO data (title, text, creation_time, last_modified_time, file_path) VALUES (?, ?, ?, ?, ?)',
+        (('Note ' + str(i), 'x' * text_size, current_time, '', '') for i in range(notes))
+    )
+    db.commit()
+    db.close()
+
+
+# Text shaped like the logs and dumps that make up large notes
+def make_log_text(size):
+    lines = []
+    length = 0
+    while length < size:
+        line = '2024-05-{:02d} 12:{:02d}:{:02d} INFO worker-{} processed request {} in {} ms\n'.format(
+            random.randint(1, 28), random.randint(0, 59), random.randint(0, 59), random.randint(1, 8),
+            random.randint(1, 10 ** 6), random.randint(1, 500))
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)[:size]
+
+
+# Counts such as 1000 and 1000000 written as 1k and 1M, and read back from either form
+def format_count(count):
+    if count >= 1000000 and count % 1000000 == 0:
+        return '{}M'.format(count // 1000000)
+    if count >= 1000 and count % 1000 == 0:
+        return '{}k'.format(count // 1000)
+    return str(count)
+
+
+def parse_count(text):
+    text = text.strip()
+    factors = {'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}
+    if text[-1:] in factors:
+        return int(float(text[:-1]) * factors[text[-1]])
+    return int(text)
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        'calls': len(durations),
+        'mean_ms': sum(durations) / len(durations) * 1000,
+        'median_ms': durations[len(durations) // 2] * 1000,
+        'p95_ms': durations[int(len(durations) * 0.95)] * 1000,
+    }
+
+
+def time_calls(function, arguments_list):
+    durations = []
+    for arguments in arguments_list:
+        start = time.perf_counter()
+        function(*arguments)
+        durations.append(time.perf_counter() - start)
+
+    return summarize(durations)
+
+
+# The connection handling of Database before it kept connections open
+def legacy_read_record(db_path, id_number):
+    db = sqlite3.connect(db_path)
+    db_cursor = db.cursor()
+    db_cursor.execute('SELECT title, text, creation_time, last_modified_time, file_path FROM data WHERE id = ?',
+                      (id_number,))
+    db_cursor.fetchall()
+    db.commit()
+    db.close()
+
+
+def legacy_update_record(db_path, id_number, text):
+    db = sqlite3.connect(db_path)
+    db_cursor = db.cursor()
+    db_cursor.execute('UPDATE data SET text = ?, last_modified_time = ? WHERE id = ?',
+                      (text, time.strftime('%Y-%m-%d %H:%M:%S'), id_number))
+    db.commit()
+    db.close()
+
+
+def benchmark_connection(notes, text_size, calls):
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        legacy_db_path = os.path.join(folder_path, 'YKPen_legacy_database.db')
+        create_legacy_database(legacy_db_path, notes, text_size)
+
+        db_path = os.path.join(folder_path, 'YKPen_database.db')
+        database = create_database(db_path, notes, text_size)
+
+        id_list = [(random.randint(1, notes),) for _ in range(calls)]
+        text = 'y' * text_size
+
+        results['legacy read_record_from_id'] = time_calls(
+            lambda id_number: legacy_read_record(legacy_db_path, id_number), id_list)
+        results['legacy update_record_from_id'] = time_calls(
+            lambda id_number: legacy_update_record(legacy_db_path, id_number, text), id_list)
+
+        results['read_record_from_id'] = time_calls(database.read_record_from_id, id_list)
+        results['update_record_from_id'] = time_calls(
+            lambda id_number: database.update_record_from_id(id_number, 'Note', text, int(time.time() * 1000), ''),
+            id_list)
+
+        database.close_db()
+
+    return results
+
+
+def benchmark_compression(notes, text_size, calls):
+    results = {}
+    texts = [make_log_text(text_size) for _ in range(20)]
+
+    # Every text is made unique, identical ones would be stored once
+    counter = itertools.count()
+
+    for codec in (None, 'zlib', 'lzma'):
+        name = codec or 'uncompressed'
+
+        with tempfile.TemporaryDirectory() as folder_path:
+            database = Database(os.path.join(folder_path, 'YKPen_database.db'))
+            database.set_compression(codec)
+
+            with database.transaction(write=True):
+                for i in range(notes):
+                    database.insert_record('Note ' + str(i), str(i) + texts[i % len(texts)], i, None, '')
+
+            db = database.open_db()
+            page_count = db.execute('PRAGMA page_count').fetchone()[0]
+            page_size = db.execute('PRAGMA page_size').fetchone()[0]
+
+            id_list = [(random.randint(1, notes),) for _ in range(calls)]
+
+            results[name + ' read_record_from_id'] = time_calls(database.read_record_from_id, id_list)
+            results[name + ' update_record_from_id'] = time_calls(
+                lambda id_number: database.update_record_from_id(
+                    id_number, 'Note', str(next(counter)) + random.choice(texts), int(time.time() * 1000), ''),
+                id_list)
+            results[name + ' read_record_from_id']['database_mb'] = page_count * page_size / (1024 * 1024)
+
+            database.close_db()
+
+    return results
+
+
+# Texts of random words, so searches find something. Notes cycle through a pool of texts and differ in their first
+# line, every note has a text of its own in blobs.
+def make_text_pool(text_size, count=1000, seed=1):
+    generator = random.Random(seed)
+    pool = []
+    for _ in range(count):
+        text_words = []
+        length = 0
+        while length < text_size:
+            word = generator.choice(words)
+            text_words.append(word)
+            length += len(word) + 1
+        pool.append(' '.join(text_words)[:text_size])
+    return pool
+
+
+def create_synthetic_database(db_path, notes, text_size, batch_size=10000, start_time=1704067200000):
+    database = Database(db_path)
+    pool = make_text_pool(text_size)
+
+    for batch_start in range(0, notes, batch_size):
+        with database.transaction(write=True) as db_cursor:
+            blobs = []
+            records = []
+            for i in range(batch_start, min(batch_start + batch_size, notes)):
+                text = 'Note {}\n{}'.format(i, pool[i % len(pool)])
+                text_hash = hash_text(text)
+                codec, content = database.encode_text(text)
+                blobs.append((text_hash, codec, content))
+                records.append(('Note ' + str(i), text_hash, start_time + i, None, '', len(text.encode('utf-8'))))
+
+            db_cursor.executemany('INSERT OR IGNORE INTO blobs (hash, codec, content) VALUES (?, ?, ?)', blobs)
+            db_cursor.executemany(
+                'INSERT INTO data (title, text_hash, creation_time, last_modified_time, file_path, size) '
+                'VALUES (?, ?, ?, ?, ?, ?)', records
+            )
+
+    # The notes went in around the write methods, so they are indexed for search in one go
+    database.rebuild_search_index()
+
+    return database
+
+
+# Every public method of Database on a database of notes notes. Methods that walk the whole database get a hundredth
+# of the calls.
+def benchmark_database(notes, text_size, calls, folder_path):
+    results = {}
+    prefix = format_count(notes) + ' '
+    heavy_calls = max(1, calls // 100)
+
+    db_path = os.path.join(folder_path, 'YKPen_database_{}.db'.format(notes))
+    database = create_synthetic_database(db_path, notes, text_size)
+    database.close_db()
+
+    pool = make_text_pool(text_size, 100, seed=2)
+    counter = itertools.count()
+    id_list = [(random.randint(1, notes),) for _ in range(calls)]
+
+    def open_database():
+        Database(db_path).close_db()
+
+    def insert_record():
+        i = next(counter)
+        return database.insert_record('Benchmark ' + str(i), '{}\n{}'.format(i, pool[i % len(pool)]),
+                                      2000000000000 + i, None, '')
+
+    def consume_records():
+        for _ in database.iter_records():
+            pass
+
+    def empty_transaction():
+        with database.transaction():
+            pass
+
+    # The record cache is bypassed, read_record_from_id cached measures switching between two notes
+    def read_uncached_record(id_number):
+        database.record_cache.invalidate(id_number)
+        return database.read_record_from_id(id_number)
+
+    results[prefix + 'open'] = time_calls(open_database, [()] * heavy_calls)
+
+    database = Database(db_path)
+    inserted_ids = []
+    results[prefix + 'insert_record'] = time_calls(lambda: inserted_ids.append(insert_record()), [()] * calls)
+    results[prefix + 'read_ids'] = time_calls(database.read_ids, [()] * heavy_calls)
+    results[prefix + 'read_ids_page'] = time_calls(database.read_ids_page, id_list)
+    results[prefix + 'read_record_from_id'] = time_calls(read_uncached_record, id_list)
+    results[prefix + 'read_record_from_id cached'] = time_calls(
+        database.read_record_from_id, [id_list[i % 2] for i in range(calls)])
+    results[prefix + 'prefetch_records'] = time_calls(
+        lambda id_number: database.prefetch_records([id_number - 1, id_number + 1]), id_list)
+    database.record_cache.clear()
+    results[prefix + 'read_text_hash'] = time_calls(database.read_text_hash, id_list)
+    results[prefix + 'update_record_from_id'] = time_calls(
+        lambda id_number: database.update_record_from_id(
+            id_number, 'Note', '{}\n{}'.format(next(counter), random.choice(pool)), int(time.time() * 1000), ''),
+        id_list)
+    results[prefix + 'iter_records'] = time_calls(consume_records, [()] * heavy_calls)
+    results[prefix + 'search'] = time_calls(
+        database.search, [(random.choice(words) + ' ' + random.choice(words)[:3],) for _ in range(calls)])
+    results[prefix + 'read_meta'] = time_calls(database.read_meta, [('compression',)] * calls)
+    results[prefix + 'write_meta'] = time_calls(database.write_meta, [('benchmark', i) for i in range(calls)])
+    results[prefix + 'transaction'] = time_calls(empty_transaction, [()] * calls)
+    results[prefix + 'recompress'] = time_calls(database.recompress, [()] * heavy_calls)
+    results[prefix + 'remove_record_from_id'] = time_calls(
+        database.remove_record_from_id, [(id_number,) for id_number in inserted_ids])
+
+    database.close_db()
+    os.remove(db_path)
+
+    return results
+
+
+# Wait in the event loop until condition() holds, at most timeout seconds
+def wait_for(app, condition, timeout=600):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        app.processEvents()
+        time.sleep(0.001)
+
+
+# Select a note and wait until its fields are read in from the database worker
+def open_note(app, window, id_number):
+    window.select_note(id_number, window.load_database)
+    wait_for(app, lambda: window.current_id() == id_number and window.loading_id is None, 60)
+
+
+# The window on the offscreen Qt platform, with the profile folder in folder_path: startup to the first paint,
+# keystrokes through auto_save_data, opening files and removing notes
+def benchmark_editor(notes, text_size, calls, keystrokes, file_sizes, folder_path):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    os.environ['HOME'] = folder_path
+    os.environ['LOCALAPPDATA'] = folder_path
+    os.makedirs(os.path.join(folder_path, '.config'), exist_ok=True)
+
+    from PySide6.QtCore import QObject, QEvent
+    from PySide6.QtWidgets import QApplication
+
+    from YKPen import YKPen
+
+    class FirstPaint(QObject):
+        def __init__(self):
+            super(FirstPaint, self).__init__()
+            self.paint_time = None
+
+        def eventFilter(self, watched, event):
+            if event.type() == QEvent.Paint and self.paint_time is None:
+                self.paint_time = time.perf_counter()
+            return False
+
+    results = {}
+    prefix = 'editor {} '.format(format_count(notes))
+
+    db_path = os.path.join(BasicConfig.read_profile_folder_path(), 'YKPen_database.db')
+    create_synthetic_database(db_path, notes, text_size).close_db()
+
+    app = QApplication.instance() or QApplication([])
+
+    first_paint = FirstPaint()
+    start = time.perf_counter()
+    window = YKPen()
+    window.installEventFilter(first_paint)
+    window.show()
+    wait_for(app, lambda: first_paint.paint_time is not None, 60)
+    results[prefix + 'startup_to_first_paint'] = summarize([(first_paint.paint_time or time.perf_counter()) - start])
+    window.removeEventFilter(first_paint)
+
+    # The schema checks and the first page of the note list follow the first paint
+    wait_for(app, lambda: window.database_loaded, 60)
+    results[prefix + 'startup_to_note_list'] = summarize([time.perf_counter() - start])
+
+    # Typing into the newest note, every keystroke runs auto_save_data through textChanged
+    open_note(app, window, notes)
+    durations = []
+    for i in range(keystrokes):
+        start = time.perf_counter()
+        window.editor.insertPlainText(words[i % len(words)][i % 3])
+        app.processEvents()
+        durations.append(time.perf_counter() - start)
+    results[prefix + 'keystroke'] = summarize(durations)
+
+    start = time.perf_counter()
+    window.auto_save.flush()
+    results[prefix + 'auto_save_flush'] = summarize([time.perf_counter() - start])
+
+    # Files are opened into the editor, the read-only view is not offered
+    window.windowed_view_threshold = max(file_sizes, default=0) * 1024 * 1024 + 1
+    for size in file_sizes:
+        file_path = os.path.join(folder_path, 'benchmark_{}MB.txt'.format(size))
+        with open(file_path, 'w', encoding='utf-8') as file:
+            file.write(make_log_text(size * 1024 * 1024))
+
+        start = time.perf_counter()
+        window.open_file_path(file_path)
+        wait_for(app, lambda: not window.file_loader.is_loading())
+        results[prefix + 'open_file_path {}MB'.format(size)] = summarize([time.perf_counter() - start])
+
+        # Edits of an opened file go to the journal, their cost should not grow with the file
+        durations = []
+        for i in range(min(keystrokes, 100)):
+            start = time.perf_counter()
+            window.editor.insertPlainText(words[i % len(words)][i % 3])
+            app.processEvents()
+            durations.append(time.perf_counter() - start)
+        results[prefix + 'journaled keystroke {}MB'.format(size)] = summarize(durations)
+        window.file_text_changes_status = False
+
+        os.remove(file_path)
+
+    window.editor.setPlainText('')
+    window.open_file_status = False
+    window.file_text_changes_status = False
+
+    durations = []
+    for id_number in range(notes, max(0, notes - calls), -1):
+        open_note(app, window, id_number)
+        start = time.perf_counter()
+        window.remove_data()
+        app.processEvents()
+        durations.append(time.perf_counter() - start)
+    if durations:
+        results[prefix + 'remove_data'] = summarize(durations)
+
+    window.auto_save.shutdown()
+    window.async_database.shutdown()
+    window.database.close_db()
+    window.journal.close()
+    window.close()
+
+    return results
+
+
+# Merging a database of notes notes into another one, half of its creation times conflicting, in every mode. Each
+# mode merges into a fresh copy of the target.
+def benchmark_merge(notes, text_size):
+    results = {}
+    prefix = 'merge {} '.format(format_count(notes))
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        target_path = os.path.join(folder_path, 'YKPen_target.db')
+        source_path = os.path.join(folder_path, 'YKPen_source.db')
+        create_synthetic_database(target_path, notes, text_size).close_db()
+        create_synthetic_database(source_path, notes, text_size, start_time=1704067200000 + notes // 2).close_db()
+
+        for mode in sorted(merge_modes):
+            db_path = os.path.join(folder_path, 'YKPen_database_{}.db'.format(mode))
+            shutil.copyfile(target_path, db_path)
+
+            database = Database(db_path)
+            merger = Merger(database, mode)
+
+            start = time.perf_counter()
+            merger.run(source_path)
+            results[prefix + mode] = summarize([time.perf_counter() - start])
+
+            database.close_db()
+
+    return results
+
+
+# One writer process of the stress benchmark, inserting, updating and removing notes of its own the way a window
+# writes them. Returns the durations per kind of write and the number of writes that failed.
+def stress_writer(db_path, writer, operations, text_size, seed):
+    database = Database(db_path)
+    generator = random.Random(seed)
+    pool = make_text_pool(text_size, 20, seed)
+
+    durations = {'insert': [], 'update': [], 'remove': []}
+    errors = 0
+    own_ids = []
+
+    # Creation times are unique, each writer takes its own range
+    first_time = 1704067200000 + writer * 1000000000
+
+    for i in range(operations):
+        choice = generator.random()
+        if not own_ids or choice < 0.5:
+            kind = 'insert'
+        elif choice < 0.9:
+            kind = 'update'
+        else:
+            kind = 'remove'
+
+        start = time.perf_counter()
+        try:
+            if kind == 'insert':
+                own_ids.append(database.insert_record('Writer {} note {}'.format(writer, i), pool[i % len(pool)],
+                                                      first_time + i, None, ''))
+            elif kind == 'update':
+                database.update_record_from_id(generator.choice(own_ids), 'Writer {} edit {}'.format(writer, i),
+                                               str(i) + pool[i % len(pool)], first_time + i, '')
+            else:
+                database.remove_record_from_id(own_ids.pop(generator.randrange(len(own_ids))))
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        durations[kind].append(time.perf_counter() - start)
+
+    database.close_db()
+
+    return durations, errors
+
+
+# Several processes write to the same database while this one polls it for changes as a window does. The notes seen
+# through read_changes() have to end up the same as the ones in the database.
+def benchmark_stress(writers, operations, text_size):
+    results = {}
+    prefix = 'stress {} writers '.format(writers)
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        db_path = os.path.join(folder_path, 'YKPen_database.db')
+        database = Database(db_path)
+
+        # id -> text hash of the notes seen by the poller
+        seen = {}
+        poll_durations = []
+
+        def poll():
+            start = time.perf_counter()
+            result = database.read_changes()
+            poll_durations.append(time.perf_counter() - start)
+            if result is None:
+                return
+
+            reload, changes = result
+            if reload:
+                seen.clear()
+                with database.transaction() as db_cursor:
+                    db_cursor.execute('SELECT id, text_hash FROM data')
+                    seen.update(db_cursor.fetchall())
+
+            for id_number, creation_time, title, text_hash in changes:
+                if creation_time is None:
+                    seen.pop(id_number, None)
+                else:
+                    seen[id_number] = text_hash
+
+        start = time.perf_counter()
+        with multiprocessing.Pool(writers) as process_pool:
+            pending = process_pool.starmap_async(
+                stress_writer, [(db_path, writer, operations, text_size, writer + 1) for writer in range(writers)])
+            while not pending.ready():
+                poll()
+                time.sleep(0.05)
+            writer_results = pending.get()
+        duration = time.perf_counter() - start
+        poll()
+
+        with database.transaction() as db_cursor:
+            db_cursor.execute('SELECT id, text_hash FROM data')
+            stored = dict(db_cursor.fetchall())
+        database.close_db()
+
+    for kind in ('insert', 'update', 'remove'):
+        durations = [duration for result, _ in writer_results for duration in result[kind]]
+        if durations:
+            results[prefix + kind] = summarize(durations)
+    errors = sum(writer_errors for _, writer_errors in writer_results)
+
+    results[prefix + 'poll'] = summarize(poll_durations)
+    results[prefix + 'poll'].update({
+        'errors': errors,
+        'writes_per_s': writers * operations / duration,
+        'consistent': seen == stored,
+    })
+
+    return results
+
+
+# A note of about text_size characters edited revisions times, a line changed or added each time and every write far
+# enough apart to keep a revision. Measures the writes, the storage of the revisions against full copies, and
+# reading revisions back.
+def benchmark_revisions(revisions, text_size, calls):
+    results = {}
+    prefix = 'revisions {} '.format(format_count(revisions))
+    generator = random.Random(1)
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        db_path = os.path.join(folder_path, 'YKPen_database.db')
+        database = Database(db_path)
+        database.keep_revisions = revisions
+
+        lines = make_log_text(text_size).splitlines(keepends=True)
+        id_number = database.insert_record('Revisions', ''.join(lines), 0, 0, '')
+
+        full_size = 0
+        durations = []
+        for i in range(1, revisions + 1):
+            line = generator.randrange(len(lines))
+            if i % 5:
+                lines[line] = '{} edited {}\n'.format(line, i)
+            else:
+                lines.insert(line, 'added {}\n'.format(i))
+            text = ''.join(lines)
+
+            start = time.perf_counter()
+            database.update_record_from_id(id_number, 'Revisions', text, i * database.revision_interval, '')
+            durations.append(time.perf_counter() - start)
+            full_size += len(text.encode('utf-8'))
+
+        with database.transaction() as db_cursor:
+            db_cursor.execute('SELECT COUNT(*), SUM(length(content)) FROM revisions')
+            stored, stored_size = db_cursor.fetchone()
+
+        results[prefix + 'update'] = summarize(durations)
+        results[prefix + 'update'].update({
+            'database_mb': os.path.getsize(db_path) / 1000000,
+            'revisions': stored,
+            'stored_mb': stored_size / 1000000,
+            'full_mb': full_size / 1000000,
+        })
+
+        revision_ids = [revision[0] for revision in database.read_revisions(id_number)]
+        results[prefix + 'read'] = time_calls(database.read_revision,
+                                              [(generator.choice(revision_ids),) for _ in range(calls)])
+        results[prefix + 'list'] = time_calls(database.read_revisions, [(id_number,)] * min(calls, 100))
+
+        database.close_db()
+
+    return results
+
+
+# rows notes inserted, read, updated and removed by the single-row methods in a loop, and by their batch variants in
+# a database of their own. Each result is the time of all rows.
+def benchmark_batch(rows, text_size):
+    results = {}
+    prefix = 'batch {} '.format(format_count(rows))
+    pool = make_text_pool(text_size)
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        for variant in ('loop', 'batch'):
+            database = Database(os.path.join(folder_path, 'YKPen_{}.db'.format(variant)))
+            records = [('Note ' + str(i), str(i) + pool[i % len(pool)], i, None, '') for i in range(rows)]
+
+            start = time.perf_counter()
+            if variant == 'loop':
+                id_numbers = [database.insert_record(*record) for record in records]
+            else:
+                id_numbers = database.insert_records(records)
+            results[prefix + 'insert ' + variant] = summarize([time.perf_counter() - start])
+
+            database.record_cache.clear()
+            start = time.perf_counter()
+            if variant == 'loop':
+                for id_number in id_numbers:
+                    database.read_record_from_id(id_number)
+            else:
+                database.read_records(id_numbers)
+            results[prefix + 'read ' + variant] = summarize([time.perf_counter() - start])
+
+            updates = [(id_number, 'Edited ' + str(i), pool[i % len(pool)] + str(i), i, '')
+                       for i, id_number in enumerate(id_numbers)]
+            start = time.perf_counter()
+            if variant == 'loop':
+                for update in updates:
+                    database.update_record_from_id(*update)
+            else:
+                database.update_records(updates)
+            results[prefix + 'update ' + variant] = summarize([time.perf_counter() - start])
+
+            start = time.perf_counter()
+            if variant == 'loop':
+                for id_number in id_numbers:
+                    database.remove_record_from_id(id_number)
+            else:
+                database.remove_records(id_numbers)
+            results[prefix + 'remove ' + variant] = summarize([time.perf_counter() - start])
+
+            database.close_db()
+
+    for operation in ('insert', 'read', 'update', 'remove'):
+        batch_result = results[prefix + operation + ' batch']
+        batch_result['speedup'] = results[prefix + operation + ' loop']['mean_ms'] / batch_result['mean_ms']
+
+    return results
+
+
+def benchmark_suite(sizes, text_size, calls, editor_notes, keystrokes, file_sizes):
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        for notes in sizes:
+            results.update(benchmark_database(notes, text_size, calls, folder_path))
+
+        if editor_notes:
+            try:
+                results.update(benchmark_editor(editor_notes, text_size, min(calls, editor_notes), keystrokes,
+                                                file_sizes, folder_path))
+            except ImportError as error:
+                print('Editor benchmarks skipped: {}'.format(error), file=sys.stderr)
+
+    return results
+
+
+def print_results(results):
+    for name, result in results.items():
+        line = '{:<40} mean {:8.3f} ms  median {:8.3f} ms  p95 {:8.3f} ms'.format(
+            name, result['mean_ms'], result['median_ms'], result['p95_ms'])
+        if 'database_mb' in result:
+            line += '  database {:.1f} MB'.format(result['database_mb'])
+        if 'speedup' in result:
+            line += '  {:.0f}x the loop'.format(result['speedup'])
+        if 'stored_mb' in result:
+            line += '  {} revisions in {:.2f} MB, {:.1f} MB as full texts'.format(
+                result['revisions'], result['stored_mb'], result['full_mb'])
+        if 'errors' in result:
+            line += '  {:.0f} writes/s, {} failed, changes {}'.format(
+                result['writes_per_s'], result['errors'], 'complete' if result['consistent'] else 'MISSED')
+        print(line)
+
+
+# Compare medians with a saved run, returns the names of the benchmarks slower by more than tolerance
+def compare_results(results, baseline, tolerance):
+    regressions = []
+
+    print()
+    print('{:<40} {:>12} {:>12} {:>8}'.format('compared to baseline', 'baseline ms', 'current ms', 'change'))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['median_ms']
+        after = result['median_ms']
+        change = (after - before) / before if before else 0.0
+
+        marker = ''
+        if change > tolerance:
+            regressions.append(name)
+            marker = '  slower'
+        print('{:<40} {:12.3f} {:12.3f} {:+7.1%}{}'.format(name, before, after, change, marker))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YKPen benchmarks')
+    parser.add_argument('benchmark', nargs='?',
+                        choices=['connection', 'compression', 'merge', 'revisions', 'stress', 'batch', 'suite'],
+                        default='connection')
+    parser.add_argument('--notes', type=int, default=100000)
+    parser.add_argument('--text-size', type=int, default=1000)
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--sizes', default='1k,100k,1M', help='database sizes of the suite, in notes')
+    parser.add_argument('--editor-notes', default='100k', help='notes in the database of the editor benchmarks, '
+                                                               '0 to skip them')
+    parser.add_argument('--writers', type=int, default=4, help='writer processes of the stress benchmark, which '
+                                                               'make --calls writes each')
+    parser.add_argument('--rows', type=int, default=10000, help='notes of the batch benchmark')
+    parser.add_argument('--revisions', type=int, default=5000, help='revisions of the note of the revisions benchmark')
+    parser.add_argument('--keystrokes', type=int, default=500)
+    parser.add_argument('--file-sizes', default='1,10,100,500', help='sizes of the opened files in MB')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.benchmark == 'suite':
+        results = benchmark_suite([parse_count(size) for size in args.sizes.split(',')], args.text_size, args.calls,
+                                  parse_count(args.editor_notes), args.keystrokes,
+                                  [int(size) for size in args.file_sizes.split(',') if size.strip()])
+    elif args.benchmark == 'merge':
+        results = benchmark_merge(args.notes, args.text_size)
+    elif args.benchmark == 'batch':
+        results = benchmark_batch(args.rows, args.text_size)
+    elif args.benchmark == 'revisions':
+        results = benchmark_revisions(args.revisions, args.text_size, args.calls)
+    elif args.benchmark == 'stress':
+        results = benchmark_stress(args.writers, args.calls, args.text_size)
+    elif args.benchmark == 'compression':
+        results = benchmark_compression(args.notes, args.text_size, args.calls)
+    else:
+        results = benchmark_connection(args.notes, args.text_size, args.calls)
+
+    print_results(results)
+
+    if args.output:
+        report = {
+            'benchmark': args.benchmark,
+            'arguments': vars(args),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'results': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+
+        if compare_results(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+# Records are (title, text, creation_time, last_modified_time, file_path), kept with the hash of the text
+def record_size(record, text_hash):
+    title, text, _, _, file_path = record
+    return sys.getsizeof(text) + sys.getsizeof(title) + sys.getsizeof(file_path) + sys.getsizeof(text_hash) + 200
+
+
+class RecordCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_ratio=0.25):
+        super(RecordCache, self).__init__()
+
+        # The least recently used records are dropped once the sizes add up to more than max_bytes. A record
+        # larger than max_entry_ratio of the budget is not kept, it would push out everything else.
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = int(max_bytes * max_entry_ratio)
+
+        # id -> (record, text hash, size), oldest first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        # The database worker, the prefetch and the maintenance may all reach the cache
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, id_number):
+        with self.lock:
+            entry = self.entries.get(id_number)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(id_number)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def contains(self, id_number):
+        with self.lock:
+            return id_number in self.entries
+
+    def put(self, id_number, record, text_hash):
+        with self.lock:
+            self.store(id_number, record, text_hash)
+
+    # A record written to the database replaces the cached one, the creation time does not change
+    def update(self, id_number, title, text, last_modified_time, file_path, text_hash):
+        with self.lock:
+            entry = self.entries.get(id_number)
+            if entry is None:
+                return
+
+            creation_time = entry[0][2]
+            self.store(id_number, (title, text, creation_time, last_modified_time, file_path), text_hash)
+
+    def invalidate(self, id_number):
+        with self.lock:
+            self.remove_entry(id_number)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    # store() and remove_entry() are called with the lock held
+    def store(self, id_number, record, text_hash):
+        self.remove_entry(id_number)
+
+        size = record_size(record, text_hash)
+        if size > self.max_entry_bytes:
+            return
+
+        self.entries[id_number] = (record, text_hash, size)
+        self.total_bytes += size
+
+        while self.total_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.evictions += 1
+
+    def remove_entry(self, id_number):
+        entry = self.entries.pop(id_number, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
@@ -1,6 +1,98 @@
 import os
+import re
 import sys
+import lzma
+import time
+import zlib
+import random
+import hashlib
 import sqlite3
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from ykpcache import RecordCache
+from ykpdelta import make_delta, apply_delta, compress_text, decompress_text
+from ykptrace import traced, span, count
+
+
+# Codecs for note texts in storage, stored texts without a codec are plain
+text_codecs = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+def encode_text(text, codec, threshold):
+    if codec is None or text is None or len(text) < threshold:
+        return None, text
+
+    compress, _ = text_codecs[codec]
+    return codec, compress(text.encode('utf-8'))
+
+
+def decode_text(codec, value):
+    if codec is None or value is None:
+        return value
+
+    _, decompress = text_codecs[codec]
+    return decompress(value).decode('utf-8')
+
+
+# Texts are stored once per content in the blobs table, keyed by this hash
+def hash_text(text):
+    if text is None:
+        return None
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# Times are epoch milliseconds, older versions stored local time as text
+def parse_time(value):
+    if value is None or isinstance(value, int):
+        return value
+
+    for time_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return int(round(datetime.strptime(value, time_format).timestamp() * 1000))
+        except ValueError:
+            pass
+
+    return None
+
+
+# Epoch milliseconds as local time text that parse_time() reads back, with the milliseconds shown when there are any
+def format_time(milliseconds, show_milliseconds=True):
+    if milliseconds is None:
+        return ''
+
+    date_time = datetime.fromtimestamp(milliseconds // 1000)
+    if show_milliseconds and milliseconds % 1000:
+        return date_time.strftime('%Y-%m-%d %H:%M:%S') + '.{:03d}'.format(milliseconds % 1000)
+    return date_time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+data_columns = 'id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, text_hash TEXT, creation_time INTEGER, ' \
+               'last_modified_time INTEGER, file_path TEXT, size INTEGER'
+
+search_triggers = ('data_search_insert', 'data_search_delete', 'data_search_update_old', 'data_search_update')
+
+# Statements with IN (...) take at most this many ids, older SQLite builds allow 999 variables per statement
+max_variables = 500
+
+
+def iter_chunks(values, size=max_variables):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Rows kept in the changes table, a reader that falls further behind reloads everything
+change_log_size = 10000
+
+
+# Another connection holds the write lock
+def is_busy(error):
+    return getattr(error, 'sqlite_errorcode', None) == 5 or 'locked' in str(error)
 
 
 class BasicConfig:
@@ -25,60 +117,577 @@ class BasicConfig:
 
 
 class Database:
-    def __init__(self):
+    def __init__(self, db_path=None, initialize=True):
         super(Database, self).__init__()
 
         self.basicconfig = BasicConfig()
-        self.db = None
-        self.db_cursor = None
+        self.db_path = db_path
+
+        # One connection per thread, kept open for the lifetime of the app
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        # Full-text search needs an SQLite build with FTS5
+        self.search_available = False
+
+        # Compression of stored texts is opt-in, see set_compression()
+        self.compression = None
+        self.compression_threshold = 4096
+
+        # Recently read records, so switching back and forth between notes does not read them again
+        self.record_cache = RecordCache()
+
+        # Other windows and processes may write to the same file. A write waits busy_timeout seconds for the lock,
+        # then is tried again up to write_retries times after a growing pause.
+        self.busy_timeout = 5.0
+        self.write_retries = 4
+        self.retry_delay = 0.2
 
-        self.profile_folder_path = self.basicconfig.read_profile_folder_path()
+        # The last row of the changes table seen by read_changes()
+        self.change_seq = None
 
-        self.initialize_db()
+        # Earlier texts of a note are kept as revisions, at most one per revision_interval milliseconds of writes
+        # and keep_revisions per note. Every keyframe_interval-th revision is stored in full, the others as deltas.
+        self.revision_interval = 5 * 60 * 1000
+        self.keyframe_interval = 32
+        self.keep_revisions = 500
+
+        if self.db_path is None:
+            self.profile_folder_path = self.basicconfig.read_profile_folder_path()
+
+        # The window initializes the database itself after it is shown
+        if initialize:
+            self.initialize_db()
 
     def read_db_path(self):
+        if self.db_path is not None:
+            return self.db_path
+
         db_path = os.path.join(self.profile_folder_path, 'YKPen_database.db')
         return db_path
 
-    def initialize_db(self):
-        self.open_db()
+    # Ordered schema migrations, the step at index n takes a database from user_version n to n + 1
+    migrations = ['migrate_blobs_table', 'migrate_texts_to_blobs', 'migrate_typed_columns', 'migrate_changes_table',
+                  'migrate_revisions_table']
+
+    @traced()
+    def initialize_db(self, progress=None):
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+
+        self.compression = self.read_meta('compression')
+        self.compression_threshold = int(self.read_meta('compression_threshold', 4096))
+
+        self.migrate(progress)
+        self.initialize_search_index()
+
+        # Changes made before this point are in what the window reads first
+        with self.transaction() as db_cursor:
+            db_cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM changes')
+            self.change_seq = db_cursor.fetchone()[0]
 
-        self.db_cursor.execute(
-            'CREATE TABLE IF NOT EXISTS data (id INTEGER PRIMARY KEY AUTOINCREMENT, '
-            'title, text, creation_time, last_modified_time, file_path)'
+    def read_schema_version(self):
+        db = self.open_db()
+        return db.execute('PRAGMA user_version').fetchone()[0]
+
+    # Bring the schema up to date. progress, if given, is called as progress(step, done, total) while a step
+    # runs. Steps commit in batches and continue where they stopped when interrupted.
+    def migrate(self, progress=None):
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'data'")
+            if db_cursor.fetchone() is None:
+                self.create_schema(db_cursor)
+                db_cursor.execute('PRAGMA user_version = {}'.format(len(self.migrations)))
+                return
+
+        version = self.read_schema_version()
+        for step in self.migrations[version:]:
+            getattr(self, step)(progress)
+
+            version += 1
+            with self.transaction(write=True) as db_cursor:
+                db_cursor.execute('PRAGMA user_version = {}'.format(version))
+
+    # The current schema, for new database files
+    def create_schema(self, db_cursor):
+        db_cursor.execute('CREATE TABLE data (' + data_columns + ')')
+        self.create_blobs_table(db_cursor)
+        self.create_time_indexes(db_cursor, 'data')
+        self.create_blob_triggers(db_cursor)
+        self.create_changes_table(db_cursor)
+        self.create_revisions_table(db_cursor)
+
+    def create_blobs_table(self, db_cursor):
+        db_cursor.execute(
+            'CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, codec TEXT, content, '
+            'refcount INTEGER NOT NULL DEFAULT 0)'
         )
 
-        self.close_db()
+    # Creation times identify notes in the list and are unique, notes are also found by modification time
+    def create_time_indexes(self, db_cursor, table_name):
+        db_cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS data_creation_ms ON {} (creation_time)'.format(table_name))
+        db_cursor.execute(
+            'CREATE INDEX IF NOT EXISTS data_last_modified_ms ON {} (last_modified_time)'.format(table_name)
+        )
 
-    def open_db(self):
+    # Every note holds a reference on its text, a text nothing refers to any more is deleted
+    def create_blob_triggers(self, db_cursor):
+        db_cursor.execute(
+            'CREATE TRIGGER IF NOT EXISTS data_blobs_insert AFTER INSERT ON data BEGIN '
+            'UPDATE blobs SET refcount = refcount + 1 WHERE hash = new.text_hash; END'
+        )
+        db_cursor.execute(
+            'CREATE TRIGGER IF NOT EXISTS data_blobs_delete AFTER DELETE ON data BEGIN '
+            'UPDATE blobs SET refcount = refcount - 1 WHERE hash = old.text_hash; '
+            'DELETE FROM blobs WHERE hash = old.text_hash AND refcount <= 0; END'
+        )
+        db_cursor.execute(
+            'CREATE TRIGGER IF NOT EXISTS data_blobs_update AFTER UPDATE OF text_hash ON data BEGIN '
+            'UPDATE blobs SET refcount = refcount + 1 WHERE hash = new.text_hash; '
+            'UPDATE blobs SET refcount = refcount - 1 WHERE hash = old.text_hash; '
+            'DELETE FROM blobs WHERE hash = old.text_hash AND refcount <= 0; END'
+        )
+
+    # Ids of added, changed and removed notes in the order of their writes, for read_changes()
+    def create_changes_table(self, db_cursor):
+        db_cursor.execute('CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER)')
+
+        # Each write also drops the rows beyond change_log_size, so the table keeps its size
+        log_change = 'INSERT INTO changes (id) VALUES ({}.id); ' \
+                     'DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - {}; END'
+        db_cursor.execute('CREATE TRIGGER IF NOT EXISTS data_changes_insert AFTER INSERT ON data BEGIN ' +
+                          log_change.format('new', change_log_size))
+        db_cursor.execute('CREATE TRIGGER IF NOT EXISTS data_changes_delete AFTER DELETE ON data BEGIN ' +
+                          log_change.format('old', change_log_size))
+        db_cursor.execute('CREATE TRIGGER IF NOT EXISTS data_changes_update AFTER UPDATE OF title, text_hash, '
+                          'last_modified_time, file_path ON data BEGIN ' + log_change.format('new', change_log_size))
+
+    # Earlier texts of the notes, see capture_revision(). keyframe_id is the revision stored in full that a delta
+    # builds on, None for that revision itself, and depth counts the deltas from it.
+    def create_revisions_table(self, db_cursor):
+        db_cursor.execute(
+            'CREATE TABLE IF NOT EXISTS revisions (id INTEGER PRIMARY KEY AUTOINCREMENT, note_id INTEGER NOT NULL, '
+            'time INTEGER, text_hash TEXT, size INTEGER, keyframe_id INTEGER, depth INTEGER NOT NULL, content BLOB)'
+        )
+        db_cursor.execute('CREATE INDEX IF NOT EXISTS revisions_note ON revisions (note_id, id)')
+        db_cursor.execute('CREATE INDEX IF NOT EXISTS revisions_keyframe ON revisions (keyframe_id, id)')
+        db_cursor.execute('CREATE TRIGGER IF NOT EXISTS data_revisions_delete AFTER DELETE ON data BEGIN '
+                          'DELETE FROM revisions WHERE note_id = old.id; END')
+
+    # Version 1: the blobs table and the columns that refer to it
+    @traced()
+    def migrate_blobs_table(self, progress=None):
+        with self.transaction(write=True) as db_cursor:
+            self.create_blobs_table(db_cursor)
+
+            db_cursor.execute('PRAGMA table_info(data)')
+            columns = [row[1] for row in db_cursor.fetchall()]
+            if 'codec' not in columns:
+                db_cursor.execute('ALTER TABLE data ADD COLUMN codec')
+            if 'text_hash' not in columns:
+                db_cursor.execute('ALTER TABLE data ADD COLUMN text_hash')
+
+                # The search triggers of older versions read data.text. The texts do not change while they move
+                # to blobs, so the index stays valid without them and initialize_search_index() recreates them.
+                for trigger_name in search_triggers:
+                    db_cursor.execute('DROP TRIGGER IF EXISTS ' + trigger_name)
+                db_cursor.execute("DELETE FROM meta WHERE key = 'recompress_last_id'")
+
+            self.create_blob_triggers(db_cursor)
+
+    # Version 2: texts of older versions are kept in data itself, they move to blobs batch_size rows per
+    # transaction. Rows already moved have no text left, so an interrupted run continues where it stopped.
+    @traced()
+    def migrate_texts_to_blobs(self, progress=None, batch_size=200):
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute('SELECT COUNT(*) FROM data WHERE text IS NOT NULL')
+            total = db_cursor.fetchone()[0]
+
+        last_id = 0
+        done = 0
+
+        while True:
+            with self.transaction(write=True) as db_cursor:
+                db_cursor.execute('SELECT id, codec, text FROM data WHERE id > ? AND text IS NOT NULL '
+                                  'ORDER BY id LIMIT ?', (last_id, batch_size))
+                rows = db_cursor.fetchall()
+                if not rows:
+                    break
+
+                for id_number, codec, value in rows:
+                    text_hash, _ = self.write_blob(db_cursor, decode_text(codec, value))
+                    db_cursor.execute('UPDATE data SET text_hash = ?, codec = NULL, text = NULL WHERE id = ?',
+                                      (text_hash, id_number))
+
+                last_id = rows[-1][0]
+
+            done += len(rows)
+            if progress is not None:
+                progress('Moving texts', done, total)
+
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute("DELETE FROM meta WHERE key = 'texts_in_blobs'")
+
+    # Version 3: data is copied into a table with typed columns, times as epoch milliseconds and the size of the
+    # text, batch_size rows per transaction. The copy continues after its highest id when interrupted, and takes
+    # the place of data once complete.
+    @traced()
+    def migrate_typed_columns(self, progress=None, batch_size=500):
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute('CREATE TABLE IF NOT EXISTS data_typed (' + data_columns + ')')
+            self.create_time_indexes(db_cursor, 'data_typed')
+
+            db_cursor.execute('SELECT COUNT(*) FROM data')
+            total = db_cursor.fetchone()[0]
+            db_cursor.execute('SELECT COUNT(*), MAX(id) FROM data_typed')
+            done, last_id = db_cursor.fetchone()
+
+        db_command = 'SELECT data.id, data.title, data.text_hash, data.creation_time, data.last_modified_time, ' \
+                     'data.file_path, blobs.codec, ' \
+                     'CASE WHEN blobs.codec IS NULL THEN length(CAST(blobs.content AS BLOB)) END, ' \
+                     'CASE WHEN blobs.codec IS NOT NULL THEN blobs.content END ' \
+                     'FROM data LEFT JOIN blobs ON blobs.hash = data.text_hash WHERE data.id > ? ' \
+                     'ORDER BY data.id LIMIT ?'
+
+        last_id = last_id or 0
+
+        while True:
+            with self.transaction(write=True) as db_cursor:
+                db_cursor.execute(db_command, (last_id, batch_size))
+                rows = db_cursor.fetchall()
+                if not rows:
+                    break
+
+                for id_number, title, text_hash, creation_time, last_modified_time, file_path, codec, size, \
+                        content in rows:
+                    if codec is not None:
+                        size = len(decode_text(codec, content).encode('utf-8'))
+
+                    creation_time = parse_time(creation_time)
+                    while True:
+                        try:
+                            db_cursor.execute(
+                                'INSERT INTO data_typed (id, title, text_hash, creation_time, last_modified_time, '
+                                'file_path, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (id_number, title, text_hash, creation_time, parse_time(last_modified_time),
+                                 file_path, size)
+                            )
+                        except sqlite3.IntegrityError:
+                            # Older versions stored seconds, notes created within the same second are moved apart
+                            # by a millisecond
+                            creation_time += 1
+                        else:
+                            break
+
+                last_id = rows[-1][0]
+
+            done += len(rows)
+            if progress is not None:
+                progress('Converting notes', done, total)
+
+        with self.transaction(write=True) as db_cursor:
+            # Ids of deleted notes are not given out again, the sequence of data carries over
+            db_cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'data'")
+            result = db_cursor.fetchone()
+            sequence = result[0] if result is not None else 0
+
+            # Renaming fails while a view refers to a missing table, initialize_search_index() creates the view
+            # and the search triggers again
+            db_cursor.execute('DROP VIEW IF EXISTS data_plain')
+            db_cursor.execute('DROP TABLE data')
+            db_cursor.execute('ALTER TABLE data_typed RENAME TO data')
+            db_cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'data' AND seq < ?", (sequence,))
+            db_cursor.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'data', ? "
+                              "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'data')", (sequence,))
+
+            self.create_blob_triggers(db_cursor)
+
+    # Version 4: the changes table, see read_changes()
+    @traced()
+    def migrate_changes_table(self, progress=None):
+        with self.transaction(write=True) as db_cursor:
+            self.create_changes_table(db_cursor)
+
+    # Version 5: the revisions table
+    @traced()
+    def migrate_revisions_table(self, progress=None):
+        with self.transaction(write=True) as db_cursor:
+            self.create_revisions_table(db_cursor)
+
+    # An FTS5 index mirroring title and text of the data table. The index reads the texts through the data_plain view,
+    # which decodes compressed ones, and is kept in sync by the write methods below, see index_notes().
+    def initialize_search_index(self):
+        try:
+            with self.transaction(write=True) as db_cursor:
+                db_cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'data_search'")
+                result = db_cursor.fetchone()
+                index_current = result is not None and 'data_plain' in result[0]
+
+                # Indexes of older versions read the stored text directly
+                if result is not None and not index_current:
+                    db_cursor.execute('DROP TABLE data_search')
+
+                # Earlier versions kept the index in sync with triggers. Those called ykp_decode(), so every write to
+                # data failed on connections that do not define it, such as the sqlite3 shell.
+                for trigger_name in search_triggers:
+                    db_cursor.execute('DROP TRIGGER IF EXISTS ' + trigger_name)
+
+                # The view of older versions reads the texts from data instead of blobs
+                db_cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'data_plain'")
+                result = db_cursor.fetchone()
+                if result is None or 'blobs' not in result[0]:
+                    db_cursor.execute('DROP VIEW IF EXISTS data_plain')
+
+                db_cursor.execute(
+                    'CREATE VIEW IF NOT EXISTS data_plain AS '
+                    'SELECT data.id AS id, data.title AS title, ykp_decode(blobs.codec, blobs.content) AS text '
+                    'FROM data LEFT JOIN blobs ON blobs.hash = data.text_hash'
+                )
+                db_cursor.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS data_search USING fts5(title, text, content = 'data_plain', "
+                    "content_rowid = 'id', prefix = '2 3')"
+                )
+
+                # Databases created before the index existed are indexed once
+                if not index_current:
+                    self.rebuild_search_index()
+        except sqlite3.OperationalError:
+            self.search_available = False
+        else:
+            self.search_available = True
+
+    # Notes are taken out of the search index before they change, while data_plain still has the text they were
+    # indexed with, and put back in once they have changed
+    def unindex_notes(self, db_cursor, id_numbers):
+        if not self.search_available:
+            return
+
+        # A note taken out twice would corrupt the index
+        for chunk in iter_chunks(list(dict.fromkeys(id_numbers))):
+            db_cursor.execute("INSERT INTO data_search (data_search, rowid, title, text) "
+                              "SELECT 'delete', id, title, text FROM data_plain "
+                              "WHERE id IN ({})".format(', '.join('?' * len(chunk))), chunk)
+
+    def index_notes(self, db_cursor, id_numbers):
+        if not self.search_available:
+            return
+
+        for chunk in iter_chunks(list(dict.fromkeys(id_numbers))):
+            db_cursor.execute('INSERT INTO data_search (rowid, title, text) SELECT id, title, text FROM data_plain '
+                              'WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk)
+
+    # Index the notes added after after_id, for inserts of many notes at once
+    def index_notes_after(self, db_cursor, after_id):
+        if not self.search_available:
+            return
+
+        db_cursor.execute('INSERT INTO data_search (rowid, title, text) SELECT id, title, text FROM data_plain '
+                          'WHERE id > ?', (after_id,))
+
+    # Writers that do not go through Database leave the index behind, a rebuild indexes every note again
+    @traced()
+    def rebuild_search_index(self):
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute("INSERT INTO data_search (data_search) VALUES ('rebuild')")
+
+    def connect(self):
         db_path = self.read_db_path()
-        self.db = sqlite3.connect(db_path)
-        self.db_cursor = self.db.cursor()
+
+        # Transactions are opened explicitly by transaction(). Each connection is only used by the thread
+        # that opened it, close_db() may release it from another thread at exit. timeout sets the busy timeout.
+        db = sqlite3.connect(db_path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+
+        # Free pages are given back in small steps by ykpmaintenance. This only applies to new database files,
+        # before WAL mode writes the header, existing ones switch at their next VACUUM.
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('PRAGMA cache_size = -16000')
+        db.execute('PRAGMA temp_store = MEMORY')
+
+        # Lets the search index read compressed texts
+        db.create_function('ykp_decode', 2, decode_text, deterministic=True)
+
+        return db
+
+    def open_db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.connect()
+            self.local.db = db
+            with self.connections_lock:
+                self.connections.append(db)
+
+        return db
+
+    # Close the connection of the calling thread, for threads that end before the app does
+    def close_thread_db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            return
+
+        self.local.db = None
+        with self.connections_lock:
+            if db in self.connections:
+                self.connections.remove(db)
+        db.close()
 
     def close_db(self):
-        self.db.commit()
-        self.db.close()
+        with self.connections_lock:
+            connections = self.connections
+            self.connections = []
+
+        for db in connections:
+            db.close()
+
+        self.local = threading.local()
+
+        # The file may be swapped before it is opened again
+        self.record_cache.clear()
+
+    # Run a block of statements in a single transaction, nested blocks join the outer one. A write transaction
+    # takes the write lock at the start, a read one that turns into a write could fail halfway when another
+    # connection writes at the same time.
+    @contextmanager
+    def transaction(self, write=False):
+        db = self.open_db()
+        db_cursor = db.cursor()
+
+        if db.in_transaction:
+            yield db_cursor
+            return
+
+        if write:
+            self.begin_write(db_cursor)
+        else:
+            db_cursor.execute('BEGIN')
+        try:
+            yield db_cursor
+        except BaseException:
+            db.rollback()
+            # Records read or written in the transaction may have gone into the cache
+            self.record_cache.clear()
+            raise
+        else:
+            db.commit()
+
+    # Group calls that write into one commit, such as several batch methods: the calls join the block, which takes the
+    # write lock at the start
+    @contextmanager
+    def batch(self):
+        with self.transaction(write=True) as db_cursor:
+            yield db_cursor
+
+    # The busy timeout has run out when BEGIN IMMEDIATE fails as busy, it is tried again after a pause that doubles
+    # each time, with some randomness so the waiting writers do not all come back at once
+    def begin_write(self, db_cursor):
+        for attempt in range(self.write_retries + 1):
+            try:
+                db_cursor.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as error:
+                if not is_busy(error) or attempt == self.write_retries:
+                    raise
+
+            count(retries=1)
+            time.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    # Store a text in blobs unless the same text is there already, and return its hash and its size in bytes. The
+    # triggers count the reference once a note points at it, so this runs in the transaction that writes the note.
+    def write_blob(self, db_cursor, text):
+        if text is None:
+            return None, None
+
+        data = text.encode('utf-8')
+        text_hash = hashlib.sha256(data).hexdigest()
+
+        db_cursor.execute('SELECT 1 FROM blobs WHERE hash = ?', (text_hash,))
+        if db_cursor.fetchone() is None:
+            codec, content = self.encode_text(text)
+            db_cursor.execute('INSERT INTO blobs (hash, codec, content) VALUES (?, ?, ?)', (text_hash, codec, content))
+
+        return text_hash, len(data)
+
+    # write_blob() for many texts, the hashes already stored are looked up a chunk at a time and every new text is
+    # encoded once
+    def write_blobs(self, db_cursor, texts):
+        hashed = []
+        for text in texts:
+            if text is None:
+                hashed.append((None, None, None))
+            else:
+                data = text.encode('utf-8')
+                hashed.append((hashlib.sha256(data).hexdigest(), len(data), text))
+
+        stored = set()
+        for chunk in iter_chunks(list({text_hash for text_hash, _, _ in hashed if text_hash is not None})):
+            db_cursor.execute('SELECT hash FROM blobs WHERE hash IN ({})'.format(', '.join('?' * len(chunk))), chunk)
+            stored.update(row[0] for row in db_cursor.fetchall())
+
+        new_blobs = {}
+        for text_hash, _, text in hashed:
+            if text_hash is not None and text_hash not in stored and text_hash not in new_blobs:
+                new_blobs[text_hash] = self.encode_text(text)
+
+        db_cursor.executemany('INSERT INTO blobs (hash, codec, content) VALUES (?, ?, ?)',
+                              [(text_hash, codec, content) for text_hash, (codec, content) in new_blobs.items()])
+
+        return [(text_hash, size) for text_hash, size, _ in hashed]
 
-    # Add a record
+    # Add a record, times are epoch milliseconds
+    @traced()
     def insert_record(self, title, text, creation_time, last_modified_time, file_path):
-        self.open_db()
+        db_command = 'INSERT INTO data (title, text_hash, creation_time, last_modified_time, file_path, size) ' \
+                     'VALUES (?, ?, ?, ?, ?, ?)'
 
-        db_command = 'INSERT INTO data (title, text, creation_time, last_modified_time, file_path) ' \
-                     'VALUES (?, ?, ?, ?, ?)'
+        with self.transaction(write=True) as db_cursor:
+            text_hash, size = self.write_blob(db_cursor, text)
+            db_cursor.execute(
+                db_command, (title, text_hash, creation_time, last_modified_time, file_path, size)
+            )
+            id_number = db_cursor.lastrowid
+            self.index_notes(db_cursor, [id_number])
 
-        self.db_cursor.execute(
-            db_command, (title, text, creation_time, last_modified_time, file_path)
-        )
+        count(rows=1, chars=len(text or ''))
+
+        return id_number
+
+    # Add records of (title, text, creation time, last modified time, file path) in one transaction, returns their ids
+    @traced()
+    def insert_records(self, records):
+        records = list(records)
+        if not records:
+            return []
+
+        db_command = 'INSERT INTO data (title, text_hash, creation_time, last_modified_time, file_path, size) ' \
+                     'VALUES (?, ?, ?, ?, ?, ?)'
+
+        with self.transaction(write=True) as db_cursor:
+            blobs = self.write_blobs(db_cursor, [record[1] for record in records])
+            db_cursor.executemany(
+                db_command,
+                [(title, text_hash, creation_time, last_modified_time, file_path, size)
+                 for (title, _, creation_time, last_modified_time, file_path), (text_hash, size) in zip(records, blobs)]
+            )
+
+            # The write lock is held throughout, so the rows got the ids up to the last one in a row
+            db_cursor.execute('SELECT last_insert_rowid()')
+            last_id = db_cursor.fetchone()[0]
+            self.index_notes_after(db_cursor, last_id - len(records))
+
+        count(rows=len(records), chars=sum(len(record[1] or '') for record in records))
 
-        self.close_db()
+        return list(range(last_id - len(records) + 1, last_id + 1))
 
     # Read ids
+    @traced()
     def read_ids(self):
-        self.open_db()
-
         db_command = 'SELECT id, creation_time FROM data ORDER BY id DESC'
-        self.db_cursor.execute(db_command)
-        result = self.db_cursor.fetchall()
+
+        with self.transaction() as db_cursor:
+            db_cursor.execute(db_command)
+            result = db_cursor.fetchall()
 
         if result:
             id_list, creation_time_list = zip(*result)
@@ -88,43 +697,458 @@ class Database:
             id_list = []
             creation_time_list = []
 
-        self.close_db()
+        count(rows=len(id_list))
 
         return id_list, creation_time_list
 
+    # Read a page of ids below before_id, newest first
+    @traced()
+    def read_ids_page(self, before_id=None, limit=200):
+        if before_id is None:
+            db_command = 'SELECT id, creation_time FROM data ORDER BY id DESC LIMIT ?'
+            parameters = (limit,)
+        else:
+            db_command = 'SELECT id, creation_time FROM data WHERE id < ? ORDER BY id DESC LIMIT ?'
+            parameters = (before_id, limit)
+
+        with self.transaction() as db_cursor:
+            db_cursor.execute(db_command, parameters)
+            result = db_cursor.fetchall()
+
+        count(rows=len(result))
+
+        return result
+
     # Read a record from id
+    @traced()
     def read_record_from_id(self, id_number):
-        self.open_db()
+        cached = self.record_cache.get(id_number)
+        if cached is not None:
+            count(cached=1)
+            return cached[0]
 
-        db_command = 'SELECT title, text, creation_time, last_modified_time, file_path FROM data WHERE id = ?'
-        self.db_cursor.execute(db_command, (id_number,))
-        result = self.db_cursor.fetchall()
+        db_command = 'SELECT data.title, blobs.codec, blobs.content, data.creation_time, data.last_modified_time, ' \
+                     'data.file_path, data.text_hash FROM data LEFT JOIN blobs ON blobs.hash = data.text_hash ' \
+                     'WHERE data.id = ?'
 
-        self.close_db()
+        with self.transaction() as db_cursor:
+            db_cursor.execute(db_command, (id_number,))
+            result = db_cursor.fetchall()
 
         record = result[0]
 
         title = record[0]
-        text = record[1]
-        creation_time = record[2]
-        last_modified_time = record[3]
-        file_path = record[4]
+        text = decode_text(record[1], record[2])
+        creation_time = record[3]
+        last_modified_time = record[4]
+        file_path = record[5]
 
-        return title, text, creation_time, last_modified_time, file_path
+        count(rows=1, chars=len(text or ''))
+
+        record = title, text, creation_time, last_modified_time, file_path
+        self.record_cache.put(id_number, record, result[0][6])
+
+        return record
+
+    # Read the records of id_numbers, in their order and None for ids that do not exist. Records read here are not put
+    # into the record cache, a batch would push out the notes being switched between.
+    @traced()
+    def read_records(self, id_numbers):
+        id_numbers = list(id_numbers)
+
+        records = {}
+        missing = []
+        for id_number in id_numbers:
+            cached = self.record_cache.get(id_number)
+            if cached is not None:
+                records[id_number] = cached[0]
+            else:
+                missing.append(id_number)
+
+        db_command = 'SELECT data.id, data.title, blobs.codec, blobs.content, data.creation_time, ' \
+                     'data.last_modified_time, data.file_path FROM data ' \
+                     'LEFT JOIN blobs ON blobs.hash = data.text_hash WHERE data.id IN ({})'
+
+        with self.transaction() as db_cursor:
+            for chunk in iter_chunks(missing):
+                db_cursor.execute(db_command.format(', '.join('?' * len(chunk))), chunk)
+                for id_number, title, codec, value, creation_time, last_modified_time, file_path in db_cursor:
+                    records[id_number] = title, decode_text(codec, value), creation_time, last_modified_time, file_path
+
+        count(rows=len(records))
+
+        return [records.get(id_number) for id_number in id_numbers]
+
+    # Read the records of the ids that are not cached yet into the cache, such as the neighbours of the open note.
+    # Records too large for the cache are not read.
+    @traced()
+    def prefetch_records(self, id_numbers):
+        id_numbers = [id_number for id_number in id_numbers
+                      if id_number is not None and not self.record_cache.contains(id_number)]
+        if not id_numbers:
+            return
+
+        db_command = 'SELECT data.id, data.title, blobs.codec, blobs.content, data.creation_time, ' \
+                     'data.last_modified_time, data.file_path, data.text_hash FROM data ' \
+                     'LEFT JOIN blobs ON blobs.hash = data.text_hash ' \
+                     'WHERE data.id IN ({}) AND COALESCE(data.size, 0) <= ?'.format(', '.join('?' * len(id_numbers)))
+
+        with self.transaction() as db_cursor:
+            db_cursor.execute(db_command, id_numbers + [self.record_cache.max_entry_bytes])
+            rows = db_cursor.fetchall()
+
+        for id_number, title, codec, value, creation_time, last_modified_time, file_path, text_hash in rows:
+            record = title, decode_text(codec, value), creation_time, last_modified_time, file_path
+            self.record_cache.put(id_number, record, text_hash)
+
+        count(rows=len(rows))
+
+    # The hash of the stored text, a text has changed if its hash_text() differs
+    @traced()
+    def read_text_hash(self, id_number):
+        cached = self.record_cache.get(id_number)
+        if cached is not None:
+            return cached[1]
+
+        with self.transaction() as db_cursor:
+            db_cursor.execute('SELECT text_hash FROM data WHERE id = ?', (id_number,))
+            result = db_cursor.fetchone()
+
+        if result is None:
+            return None
+
+        return result[0]
+
+    # Iterate over all records in id order, fetching batch_size rows at a time so memory stays flat
+    def iter_records(self, batch_size=100):
+        db_command = 'SELECT data.id, data.title, blobs.codec, blobs.content, data.creation_time, ' \
+                     'data.last_modified_time, data.file_path FROM data ' \
+                     'LEFT JOIN blobs ON blobs.hash = data.text_hash ORDER BY data.id'
+
+        # The read transaction gives a consistent snapshot for the whole iteration. The span covers the fetching,
+        # not the time the caller spends between records.
+        with self.transaction() as db_cursor:
+            db_cursor.execute(db_command)
+            while True:
+                with span('Database.iter_records') as current:
+                    rows = db_cursor.fetchmany(batch_size)
+                    records = [(id_number, title, decode_text(codec, value), creation_time, last_modified_time,
+                                file_path)
+                               for id_number, title, codec, value, creation_time, last_modified_time, file_path in rows]
+                    current.count(rows=len(records))
+                if not records:
+                    break
+                for record in records:
+                    yield record
 
     # Update a record from id
+    @traced()
     def update_record_from_id(self, id_number, title, text, last_modified_time, file_path):
-        self.open_db()
-        db_command = 'UPDATE data SET title = ?, text = ?, last_modified_time = ?, file_path = ? WHERE id = ?'
-        self.db_cursor.execute(db_command, (title, text, last_modified_time, file_path, id_number))
-        self.close_db()
+        db_command = 'UPDATE data SET title = ?, text_hash = ?, last_modified_time = ?, file_path = ?, size = ? ' \
+                     'WHERE id = ?'
+
+        with self.transaction(write=True) as db_cursor:
+            text_hash, size = self.write_blob(db_cursor, text)
+            self.capture_revision(db_cursor, id_number, text_hash)
+            self.unindex_notes(db_cursor, [id_number])
+            db_cursor.execute(db_command, (title, text_hash, last_modified_time, file_path, size, id_number))
+            self.index_notes(db_cursor, [id_number])
+            self.record_cache.update(id_number, title, text, last_modified_time, file_path, text_hash)
+
+        count(rows=1, chars=len(text or ''))
+
+    # Update records of (id, title, text, last modified time, file path) in one transaction. A note listed more than
+    # once gets its last record.
+    @traced()
+    def update_records(self, records):
+        records = list({record[0]: record for record in records}.values())
+        if not records:
+            return
+
+        db_command = 'UPDATE data SET title = ?, text_hash = ?, last_modified_time = ?, file_path = ?, size = ? ' \
+                     'WHERE id = ?'
+
+        with self.transaction(write=True) as db_cursor:
+            blobs = self.write_blobs(db_cursor, [record[2] for record in records])
+
+            rows = []
+            for (id_number, title, _, last_modified_time, file_path), (text_hash, size) in zip(records, blobs):
+                self.capture_revision(db_cursor, id_number, text_hash)
+                rows.append((title, text_hash, last_modified_time, file_path, size, id_number))
+
+            id_numbers = [record[0] for record in records]
+            self.unindex_notes(db_cursor, id_numbers)
+            db_cursor.executemany(db_command, rows)
+            self.index_notes(db_cursor, id_numbers)
+
+            for (id_number, title, text, last_modified_time, file_path), (text_hash, _) in zip(records, blobs):
+                self.record_cache.update(id_number, title, text, last_modified_time, file_path, text_hash)
+
+        count(rows=len(records), chars=sum(len(record[2] or '') for record in records))
 
-    # Remove a record from id
+    # Keep the text a note has before an update as a revision, unless the last revision is less than
+    # revision_interval older, so a burst of autosaves leaves one revision. A revision is a delta to the one before
+    # it, or the full text every keyframe_interval revisions and where the delta would not be much smaller, so reading
+    # one applies fewer than keyframe_interval deltas.
+    def capture_revision(self, db_cursor, id_number, text_hash):
+        db_cursor.execute('SELECT data.text_hash, COALESCE(data.last_modified_time, data.creation_time), '
+                          'blobs.codec, blobs.content FROM data LEFT JOIN blobs ON blobs.hash = data.text_hash '
+                          'WHERE data.id = ?', (id_number,))
+        result = db_cursor.fetchone()
+        if result is None or result[0] == text_hash or result[0] is None:
+            return
+        old_hash, old_time, codec, value = result
+
+        db_cursor.execute('SELECT id, time, text_hash, keyframe_id, depth FROM revisions WHERE note_id = ? '
+                          'ORDER BY id DESC LIMIT 1', (id_number,))
+        last = db_cursor.fetchone()
+        if last is not None:
+            last_id, last_time, last_hash, last_keyframe_id, last_depth = last
+            if last_hash == old_hash:
+                return
+            if old_time is not None and last_time is not None and old_time - last_time < self.revision_interval:
+                return
+
+        old_text = decode_text(codec, value) or ''
+        keyframe_id = None
+        depth = 0
+        content = compress_text(old_text)
+
+        if last is not None and last_depth + 1 < self.keyframe_interval:
+            delta = make_delta(self.read_revision(last_id), old_text)
+            if len(delta) * 2 < len(content):
+                keyframe_id = last_keyframe_id if last_keyframe_id is not None else last_id
+                depth = last_depth + 1
+                content = delta
+
+        db_cursor.execute('INSERT INTO revisions (note_id, time, text_hash, size, keyframe_id, depth, content) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (id_number, old_time, old_hash, len(old_text), keyframe_id, depth, content))
+        count(revisions=1, bytes=len(content))
+
+        self.prune_revisions(db_cursor, id_number)
+
+    # Revisions beyond the newest keep_revisions of a note are removed. Deltas need the revisions before them up to
+    # their keyframe, so the revisions go a keyframe and its deltas at a time.
+    def prune_revisions(self, db_cursor, id_number):
+        db_cursor.execute('SELECT COALESCE(keyframe_id, id) FROM revisions WHERE note_id = ? '
+                          'ORDER BY id DESC LIMIT 1 OFFSET ?', (id_number, self.keep_revisions - 1))
+        result = db_cursor.fetchone()
+        if result is None:
+            return
+
+        db_cursor.execute('DELETE FROM revisions WHERE note_id = ? AND id < ?', (id_number, result[0]))
+        count(pruned=db_cursor.rowcount)
+
+    # The revisions of a note as (revision id, time, size in characters), newest first
+    @traced()
+    def read_revisions(self, id_number):
+        with self.transaction() as db_cursor:
+            db_cursor.execute('SELECT id, time, size FROM revisions WHERE note_id = ? ORDER BY id DESC',
+                              (id_number,))
+            result = db_cursor.fetchall()
+
+        count(rows=len(result))
+
+        return result
+
+    # The text of a revision, None if there is no such revision
+    @traced()
+    def read_revision(self, revision_id):
+        with self.transaction() as db_cursor:
+            db_cursor.execute('SELECT COALESCE(keyframe_id, id) FROM revisions WHERE id = ?', (revision_id,))
+            result = db_cursor.fetchone()
+            if result is None:
+                return None
+            keyframe_id = result[0]
+
+            # A keyframe comes before its deltas
+            db_cursor.execute('SELECT content FROM revisions WHERE id = ? OR (keyframe_id = ? AND id <= ?) ORDER BY id',
+                              (keyframe_id, keyframe_id, revision_id))
+            rows = db_cursor.fetchall()
+
+        text = decompress_text(rows[0][0])
+        for delta, in rows[1:]:
+            text = apply_delta(text, delta)
+
+        count(deltas=len(rows) - 1)
+
+        return text
+
+    # Texts of at least compression_threshold characters are stored compressed when compression is on
+    def encode_text(self, text):
+        return encode_text(text, self.compression, self.compression_threshold)
+
+    # Turn compression on with one of text_codecs, or off with None. New writes follow at once, stored texts
+    # follow with recompress().
+    @traced()
+    def set_compression(self, codec, threshold=4096):
+        if codec is not None and codec not in text_codecs:
+            raise ValueError('Unknown codec: ' + codec)
+
+        self.compression = codec
+        self.compression_threshold = threshold
+
+        with self.transaction(write=True) as db_cursor:
+            self.write_meta('compression', codec)
+            self.write_meta('compression_threshold', threshold)
+            db_cursor.execute("DELETE FROM meta WHERE key = 'recompress_last_id'")
+
+    # Bring stored texts in line with the compression setting, batch_size blobs per transaction. The last rowid
+    # done is kept in meta, so an interrupted run continues from there. Returns the number of blobs rewritten.
+    @traced()
+    def recompress(self, batch_size=200, progress=None):
+        last_id = int(self.read_meta('recompress_last_id', 0))
+        rewritten = 0
+
+        while True:
+            with self.transaction(write=True) as db_cursor:
+                db_cursor.execute('SELECT rowid, codec, content FROM blobs WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                  (last_id, batch_size))
+                rows = db_cursor.fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                for id_number, codec, value in rows:
+                    new_codec, new_value = self.encode_text(decode_text(codec, value))
+                    if new_codec != codec:
+                        updates.append((new_codec, new_value, id_number))
+
+                db_cursor.executemany('UPDATE blobs SET codec = ?, content = ? WHERE rowid = ?', updates)
+
+                last_id = rows[-1][0]
+                self.write_meta('recompress_last_id', last_id)
+
+            rewritten += len(updates)
+            if progress is not None:
+                progress(last_id, rewritten)
+
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute("DELETE FROM meta WHERE key = 'recompress_last_id'")
+
+        count(rows=rewritten)
+
+        return rewritten
+
+    @traced()
+    def read_meta(self, key, default=None):
+        with self.transaction() as db_cursor:
+            db_cursor.execute('SELECT value FROM meta WHERE key = ?', (key,))
+            result = db_cursor.fetchone()
+
+        if result is None:
+            return default
+
+        return result[0]
+
+    @traced()
+    def write_meta(self, key, value):
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    # Search titles and texts, best matches first
+    @traced()
+    def search(self, query, limit=20, offset=0):
+        if not self.search_available:
+            return []
+
+        # Every word of the query is matched as a prefix, FTS5 syntax in the query is not interpreted
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return []
+
+        match_query = ' '.join('"' + term + '"*' for term in terms)
+
+        db_command = "SELECT data.id, data.creation_time, " \
+                     "snippet(data_search, 0, '', '', '...', 8), snippet(data_search, 1, '', '', '...', 16) " \
+                     'FROM data_search JOIN data ON data.id = data_search.rowid ' \
+                     'WHERE data_search MATCH ? ORDER BY rank LIMIT ? OFFSET ?'
+
+        with self.transaction() as db_cursor:
+            db_cursor.execute(db_command, (match_query, limit, offset))
+            result = db_cursor.fetchall()
+
+        count(rows=len(result))
+
+        return result
+
+    # Notes written by other connections since the last call, as (reload, changes) with changes a list of (id,
+    # creation time, title, text hash) and None for all three when the note was removed, or None if nothing
+    # changed. reload is True when the changes table no longer reaches back that far. PRAGMA data_version only
+    # changes with writes of other connections, so polling an unchanged database reads nothing else. Writes of
+    # this connection are listed too, the caller finds them already applied.
+    @traced()
+    def read_changes(self):
+        db = self.open_db()
+        data_version = db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == getattr(self.local, 'data_version', None):
+            return None
+        self.local.data_version = data_version
+
+        db_command = 'SELECT changed.id, data.creation_time, data.title, data.text_hash ' \
+                     'FROM (SELECT id, MAX(seq) AS seq FROM changes WHERE seq > ? GROUP BY id) AS changed ' \
+                     'LEFT JOIN data ON data.id = changed.id ORDER BY changed.seq'
+
+        with self.transaction() as db_cursor:
+            db_cursor.execute('SELECT MIN(seq), MAX(seq) FROM changes')
+            first_seq, last_seq = db_cursor.fetchone()
+            if last_seq is None or last_seq <= self.change_seq:
+                return None
+
+            if first_seq > self.change_seq + 1:
+                self.change_seq = last_seq
+                self.record_cache.clear()
+                return True, []
+
+            db_cursor.execute(db_command, (self.change_seq,))
+            changes = db_cursor.fetchall()
+            self.change_seq = last_seq
+
+        for change in changes:
+            self.record_cache.invalidate(change[0])
+
+        count(rows=len(changes))
+
+        return False, changes
+
+    # Start the changes of a restored database after every change seen before, so read_changes() of other
+    # connections reloads everything instead of reading changes of another file
+    def restart_changes(self, after_seq):
+        with self.transaction(write=True) as db_cursor:
+            db_cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM changes')
+            seq = max(db_cursor.fetchone()[0], after_seq) + change_log_size + 1
+            db_cursor.execute('DELETE FROM changes')
+            db_cursor.execute('INSERT INTO changes (seq, id) VALUES (?, NULL)', (seq,))
+
+        self.change_seq = seq
+        self.record_cache.clear()
+
+    # Remove a record from id, the freed pages are reclaimed later by ykpmaintenance
+    @traced()
     def remove_record_from_id(self, id_number):
-        self.open_db()
-        self.db_cursor.execute('DELETE FROM data WHERE id = ?', (id_number,))
-        self.close_db()
+        with self.transaction(write=True) as db_cursor:
+            self.unindex_notes(db_cursor, [id_number])
+            db_cursor.execute('DELETE FROM data WHERE id = ?', (id_number,))
+            count(rows=db_cursor.rowcount)
+
+        self.record_cache.invalidate(id_number)
+
+    # Remove the records of id_numbers in one transaction, returns the number removed
+    @traced()
+    def remove_records(self, id_numbers):
+        id_numbers = list(id_numbers)
+        removed = 0
+
+        with self.transaction(write=True) as db_cursor:
+            self.unindex_notes(db_cursor, id_numbers)
+            for chunk in iter_chunks(id_numbers):
+                db_cursor.execute('DELETE FROM data WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk)
+                removed += db_cursor.rowcount
+
+        for id_number in id_numbers:
+            self.record_cache.invalidate(id_number)
+
+        count(rows=removed)
 
-        self.open_db()
-        self.db_cursor.execute('VACUUM')
-        self.close_db()
+        return removed
@@ -0,0 +1,61 @@
+import json
+import zlib
+from difflib import SequenceMatcher
+
+
+# A delta turns one text into another line by line. It is a compressed JSON list whose items are either [start, end],
+# the lines start to end of the old text, or a string to insert.
+def make_delta(old_text, new_text):
+    old_lines = old_text.splitlines(keepends=True)
+    new_lines = new_text.splitlines(keepends=True)
+
+    # Most edits touch a few lines, the lines before and after them are matched without SequenceMatcher
+    prefix = 0
+    limit = min(len(old_lines), len(new_lines))
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old_lines[-suffix - 1] == new_lines[-suffix - 1]:
+        suffix += 1
+
+    old_middle = old_lines[prefix:len(old_lines) - suffix]
+    new_middle = new_lines[prefix:len(new_lines) - suffix]
+
+    operations = []
+    if prefix:
+        operations.append([0, prefix])
+
+    matcher = SequenceMatcher(None, old_middle, new_middle, autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == 'equal':
+            operations.append([prefix + old_start, prefix + old_end])
+        elif new_end > new_start:
+            operations.append(''.join(new_middle[new_start:new_end]))
+
+    if suffix:
+        operations.append([len(old_lines) - suffix, len(old_lines)])
+
+    return zlib.compress(json.dumps(operations, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def apply_delta(old_text, delta):
+    old_lines = old_text.splitlines(keepends=True)
+
+    parts = []
+    for operation in json.loads(zlib.decompress(delta).decode('utf-8')):
+        if isinstance(operation, str):
+            parts.append(operation)
+        else:
+            parts.extend(old_lines[operation[0]:operation[1]])
+
+    return ''.join(parts)
+
+
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8'))
+
+
+def decompress_text(content):
+    return zlib.decompress(content).decode('utf-8')
@@ -0,0 +1,242 @@
+import time
+import hashlib
+import threading
+
+from PySide6.QtCore import Qt, QObject, QTimer, Signal
+from PySide6.QtGui import QTextCursor
+from PySide6.QtWidgets import QPlainTextEdit, QWidget, QHBoxLayout, QScrollBar
+
+from ykpfileio import save_file_atomically
+from ykptrace import traced, count
+
+
+class EditTracker(QObject):
+    def __init__(self, document):
+        super(EditTracker, self).__init__()
+
+        self.document = document
+
+        # Each change of the document bumps the revision, the document itself is never copied
+        self.revision = 0
+        self.saved_revision = 0
+
+        self.digest = None
+        self.digest_revision = None
+
+        self.document.contentsChange.connect(self.track_change)
+
+    def track_change(self, position, removed, added):
+        if removed == 0 and added == 0:
+            return
+
+        self.revision += 1
+
+    def is_modified(self):
+        return self.revision != self.saved_revision
+
+    def is_empty(self):
+        return self.document.isEmpty()
+
+    # The digest is computed once per revision, so repeated checks between edits cost nothing
+    def content_digest(self, text=None):
+        if self.digest_revision != self.revision:
+            if text is None:
+                text = self.document.toPlainText()
+            self.digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            self.digest_revision = self.revision
+
+        return self.digest
+
+    def mark_saved(self):
+        self.saved_revision = self.revision
+
+    def reset(self):
+        self.revision += 1
+        self.mark_saved()
+
+
+class Editor(QPlainTextEdit):
+    def __init__(self, large_document_threshold=5 * 1024 * 1024):
+        super(Editor, self).__init__()
+
+        # Above the threshold lines are not wrapped, so layout only runs for the visible blocks
+        self.large_document_threshold = large_document_threshold
+        self.large_document_mode = False
+
+        self.edit_tracker = EditTracker(self.document())
+
+    def set_large_document_mode(self, enabled):
+        self.large_document_mode = enabled
+        if enabled:
+            self.setLineWrapMode(QPlainTextEdit.NoWrap)
+        else:
+            self.setLineWrapMode(QPlainTextEdit.WidgetWidth)
+
+    def setPlainText(self, text):
+        self.set_large_document_mode(len(text) > self.large_document_threshold)
+        super(Editor, self).setPlainText(text)
+        self.edit_tracker.reset()
+
+    def is_empty(self):
+        return self.edit_tracker.is_empty()
+
+
+class FileLoader(QObject):
+    progress = Signal(int, int)
+    finished = Signal()
+
+    def __init__(self, editor, chunk_size=1024 * 1024):
+        super(FileLoader, self).__init__()
+
+        self.editor = editor
+        self.chunk_size = chunk_size
+        self.mapped_file = None
+        self.chunks = None
+
+        # Qt only makes one line break of \r\n when both arrive in the same insertText(), so a \r that ends a chunk
+        # is held back for the next one
+        self.carry = ''
+
+        # One chunk per event loop turn, so the window keeps painting and responding
+        self.timer = QTimer()
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.load_chunk)
+
+    def is_loading(self):
+        return self.chunks is not None
+
+    def load(self, mapped_file):
+        self.mapped_file = mapped_file
+        self.chunks = mapped_file.iter_chunks(self.chunk_size)
+        self.carry = ''
+
+        # Chunks are not edits, the undo history starts once the whole file is in
+        self.editor.setUndoRedoEnabled(False)
+        self.editor.setPlainText('')
+        self.editor.set_large_document_mode(mapped_file.size > self.editor.large_document_threshold)
+
+        self.timer.start()
+
+    @traced()
+    def load_chunk(self):
+        try:
+            loaded_size, text = next(self.chunks)
+        except StopIteration:
+            if self.carry:
+                self.insert_text(self.carry)
+            self.stop()
+            self.finished.emit()
+            return
+
+        text = self.carry + text
+        self.carry = ''
+        if text.endswith('\r'):
+            text = text[:-1]
+            self.carry = '\r'
+
+        self.insert_text(text)
+
+        count(chars=len(text))
+
+        self.progress.emit(loaded_size, self.mapped_file.size)
+
+    def insert_text(self, text):
+        cursor = QTextCursor(self.editor.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+
+    def stop(self):
+        self.timer.stop()
+        self.chunks = None
+        self.carry = ''
+
+        if self.mapped_file is not None:
+            self.mapped_file.close()
+            self.mapped_file = None
+
+        self.editor.setUndoRedoEnabled(True)
+        self.editor.edit_tracker.reset()
+
+
+class FileSaveTask(QObject):
+    finished = Signal(str, int, float)
+    failed = Signal(str)
+
+    # The text has characters the encoding cannot hold, nothing was written
+    unencodable = Signal(str)
+
+    def __init__(self, file_path, text, encoding='utf-8'):
+        super(FileSaveTask, self).__init__()
+
+        self.file_path = file_path
+        self.text = text
+        self.encoding = encoding
+        self.thread = None
+
+    # Large documents are saved on their own thread, the signals are delivered to the UI thread
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='YKPenFileSave', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            data = self.text.encode(self.encoding)
+            written_size = save_file_atomically(self.file_path, data)
+        except UnicodeEncodeError as error:
+            self.unencodable.emit(str(error))
+        except OSError as error:
+            self.failed.emit(str(error))
+        else:
+            self.finished.emit(self.file_path, written_size, time.perf_counter() - start)
+
+
+class WindowedFileView(QWidget):
+    def __init__(self, window_size=256 * 1024):
+        super(WindowedFileView, self).__init__()
+
+        # Only window_size bytes around the scroll position are decoded and shown
+        self.window_size = window_size
+        self.mapped_file = None
+
+        self.main_layout = QHBoxLayout()
+        self.view = QPlainTextEdit()
+        self.scroll_bar = QScrollBar(Qt.Vertical)
+
+        self.main_layout.setContentsMargins(0, 0, 0, 0)
+        self.main_layout.setSpacing(0)
+        self.setLayout(self.main_layout)
+        self.main_layout.addWidget(self.view)
+        self.main_layout.addWidget(self.scroll_bar)
+
+        self.view.setReadOnly(True)
+        self.view.setLineWrapMode(QPlainTextEdit.NoWrap)
+
+        self.scroll_bar.valueChanged.connect(self.show_window)
+
+    def is_open(self):
+        return self.mapped_file is not None
+
+    def open(self, mapped_file):
+        self.close_file()
+        self.mapped_file = mapped_file
+
+        # The scroll bar counts in windows, so its range stays within int limits for any file size
+        self.scroll_bar.setRange(0, max(0, (mapped_file.size - 1) // self.window_size))
+        self.scroll_bar.setPageStep(1)
+        self.scroll_bar.setValue(0)
+        self.show_window(0)
+
+    def show_window(self, value):
+        if self.mapped_file is None:
+            return
+
+        _, _, text = self.mapped_file.read_window(value * self.window_size, self.window_size)
+        self.view.setPlainText(text)
+
+    def close_file(self):
+        if self.mapped_file is not None:
+            self.mapped_file.close()
+            self.mapped_file = None
+
+        self.view.setPlainText('')
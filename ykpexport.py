@@ -0,0 +1,168 @@
+import os
+import re
+import bz2
+import csv
+import sys
+import gzip
+import lzma
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ykpdatabase import Database, format_time
+
+
+compressions = {
+    'gzip': (gzip.open, '.gz'),
+    'bz2': (bz2.open, '.bz2'),
+    'xz': (lzma.open, '.xz'),
+}
+
+# Device names Windows does not allow as file names
+reserved_names = {'CON', 'PRN', 'AUX', 'NUL'} | {'COM' + str(i) for i in range(1, 10)} | \
+                 {'LPT' + str(i) for i in range(1, 10)}
+
+fields = ['id', 'title', 'text', 'creation_time', 'last_modified_time', 'file_path']
+
+
+def open_output(file_path, compression):
+    if compression is None:
+        return open(file_path, 'w', encoding='utf-8', newline='')
+
+    opener, _ = compressions[compression]
+    return opener(file_path, 'wt', encoding='utf-8', newline='')
+
+
+# A file name from the title that every platform accepts
+def make_file_name(title, id_number):
+    name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', title or '').strip().rstrip('. ')[:150]
+    if not name:
+        name = 'Note {}'.format(id_number)
+    if name.upper() in reserved_names:
+        name = name + '_'
+    return name
+
+
+class Exporter:
+    def __init__(self, database, compression=None, workers=4, batch_size=100):
+        super(Exporter, self).__init__()
+
+        self.database = database
+        self.compression = compression
+        self.workers = workers
+        self.batch_size = batch_size
+
+        self.exported_notes = 0
+        self.exported_bytes = 0
+
+    def count_bytes(self, text):
+        self.exported_bytes += len((text or '').encode('utf-8'))
+
+    # Times are written as local time text, they are stored as epoch milliseconds
+    @staticmethod
+    def format_record(record):
+        id_number, title, text, creation_time, last_modified_time, file_path = record
+        return id_number, title, text, format_time(creation_time), format_time(last_modified_time), file_path
+
+    # One text file per note, named by title. Names are compared case-insensitively, so notes with the same
+    # title get " (2)", " (3)" ... on every file system.
+    def export_files(self, folder_path):
+        os.makedirs(folder_path, exist_ok=True)
+
+        extension = '.txt'
+        if self.compression is not None:
+            extension += compressions[self.compression][1]
+
+        used_names = {name.lower() for name in os.listdir(folder_path)}
+
+        # At most this many notes wait for a writer, so memory does not grow with the database
+        slots = threading.BoundedSemaphore(self.workers * 4)
+
+        def write_note(file_path, text):
+            try:
+                with open_output(file_path, self.compression) as file:
+                    file.write(text)
+            finally:
+                slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for id_number, title, text, creation_time, last_modified_time, file_path in \
+                    self.database.iter_records(self.batch_size):
+                name = make_file_name(title, id_number)
+                file_name = name + extension
+                copy_number = 2
+                while file_name.lower() in used_names:
+                    file_name = '{} ({}){}'.format(name, copy_number, extension)
+                    copy_number += 1
+                used_names.add(file_name.lower())
+
+                slots.acquire()
+                futures.append(executor.submit(write_note, os.path.join(folder_path, file_name), text or ''))
+
+                self.exported_notes += 1
+                self.count_bytes(text)
+
+                # Finished writes are checked as the export goes, so errors surface early
+                while futures and futures[0].done():
+                    futures.pop(0).result()
+
+        for future in futures:
+            future.result()
+
+    def export_jsonl(self, file_path):
+        with open_output(file_path, self.compression) as file:
+            for record in self.database.iter_records(self.batch_size):
+                file.write(json.dumps(dict(zip(fields, self.format_record(record))), ensure_ascii=False))
+                file.write('\n')
+
+                self.exported_notes += 1
+                self.count_bytes(record[2])
+
+    def export_csv(self, file_path):
+        with open_output(file_path, self.compression) as file:
+            writer = csv.writer(file)
+            writer.writerow(fields)
+            for record in self.database.iter_records(self.batch_size):
+                writer.writerow(self.format_record(record))
+
+                self.exported_notes += 1
+                self.count_bytes(record[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the notes of a YKPen database')
+    parser.add_argument('output', help='folder for --format files, otherwise the file to write')
+    parser.add_argument('--database', help='database file, the profile database by default')
+    parser.add_argument('--format', choices=['files', 'jsonl', 'csv'], default='files')
+    parser.add_argument('--compress', choices=sorted(compressions), help='compress the output on the fly')
+    parser.add_argument('--workers', type=int, default=4, help='threads writing files for --format files')
+    args = parser.parse_args()
+
+    database = Database(args.database)
+    exporter = Exporter(database, args.compress, args.workers)
+
+    start = time.perf_counter()
+    try:
+        if args.format == 'files':
+            exporter.export_files(args.output)
+        elif args.format == 'jsonl':
+            exporter.export_jsonl(args.output)
+        else:
+            exporter.export_csv(args.output)
+    finally:
+        database.close_db()
+
+    duration = max(time.perf_counter() - start, 1e-9)
+    megabytes = exporter.exported_bytes / (1024 * 1024)
+
+    print('Exported {} notes ({:.1f} MB of text) in {:.2f} s: {:.0f} notes/s, {:.1f} MB/s.'.format(
+        exporter.exported_notes, megabytes, duration, exporter.exported_notes / duration, megabytes / duration))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import os
+import re
+import mmap
+import codecs
+import shutil
+import hashlib
+import tempfile
+
+from ykptrace import traced, count
+
+
+# GB2312 characters, the common Chinese ones, take two bytes of 0xA1 to 0xFE. The other GB18030 sequences are a
+# second byte of 0x40 to 0xFE or four bytes.
+gb18030_sequence = re.compile(rb'(?P<common>[\xa1-\xf7][\xa1-\xfe])|[\x81-\xfe][\x30-\x39][\x81-\xfe][\x30-\x39]|'
+                              rb'[\x81-\xfe][\x40-\xfe]')
+
+
+# Almost any bytes decode as GB18030. Text in a single byte encoding that does so pairs its accented letters with the
+# ASCII letter after them, while Chinese text is mostly made of GB2312 characters.
+def looks_like_gb18030(head, min_common_share=0.5):
+    sequences = 0
+    common = 0
+    for match in gb18030_sequence.finditer(head):
+        sequences += 1
+        if match.group('common') is not None:
+            common += 1
+
+    return sequences > 0 and common >= sequences * min_common_share
+
+
+# Guess the encoding from the first bytes of a file: a byte order mark, otherwise the first encoding that decodes.
+# complete tells whether head is the whole file, otherwise it may end in the middle of a character.
+def detect_encoding(head, complete=False):
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+
+    for encoding in ('utf-8', 'gb18030'):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            decoder.decode(head, final=complete)
+        except UnicodeDecodeError:
+            continue
+
+        if encoding == 'gb18030' and not looks_like_gb18030(head):
+            continue
+        return encoding
+
+    return 'latin-1'
+
+
+class MappedTextFile:
+    def __init__(self, file_path, head_size=64 * 1024):
+        super(MappedTextFile, self).__init__()
+
+        self.file_path = file_path
+        self.file = open(file_path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        # Empty files cannot be mapped
+        if self.size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+
+        self.encoding = detect_encoding(self.data[:head_size], self.size <= head_size)
+
+    # Decoded text in chunks of chunk_size bytes, characters split between chunks are kept whole
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+
+        for offset in range(0, self.size, chunk_size):
+            yield offset + min(chunk_size, self.size - offset), decoder.decode(self.data[offset:offset + chunk_size])
+
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield self.size, tail
+
+    # Windows are cut at newline bytes, which UTF-16 does not allow
+    def supports_windows(self):
+        return self.encoding != 'utf-16'
+
+    # The text of about length bytes from offset, widened to whole lines. A line break is only looked for up to
+    # max_line bytes away, lines longer than that, such as those of minified files, are cut between characters.
+    def read_window(self, offset, length, max_line=64 * 1024):
+        offset = max(0, min(offset, self.size))
+
+        start = self.data.rfind(b'\n', max(0, offset - max_line), offset) + 1
+        if start == 0 and offset > max_line:
+            start = self.find_character_start(offset)
+
+        end = min(start + length, self.size)
+        line_end = self.data.find(b'\n', end, min(end + max_line, self.size))
+        if line_end >= 0:
+            end = line_end
+
+        # A character cut off at the end is left out
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        return start, end, decoder.decode(self.data[start:end], final=end == self.size)
+
+    # The first position from offset where a character starts, found by the next bytes decoding cleanly
+    def find_character_start(self, offset):
+        for position in range(offset, min(offset + 4, self.size)):
+            decoder = codecs.getincrementaldecoder(self.encoding)()
+            try:
+                decoder.decode(self.data[position:position + 16])
+            except UnicodeDecodeError:
+                continue
+            return position
+
+        return offset
+
+    def close(self):
+        if self.size:
+            self.data.close()
+        self.file.close()
+
+
+def file_digest(file_path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# True if the file on disk already holds exactly data, the size is compared before anything is hashed
+def file_matches(file_path, data):
+    try:
+        if os.path.getsize(file_path) != len(data):
+            return False
+        return file_digest(file_path) == hashlib.sha256(data).hexdigest()
+    except OSError:
+        return False
+
+
+# The mode open() gives new files. The umask can only be read by setting it, which is done once here at import rather
+# than from the threads that save files.
+umask = os.umask(0)
+os.umask(umask)
+new_file_mode = 0o666 & ~umask
+
+
+# Write data to a temporary file next to the target, sync it and rename it over the target, so a crash leaves
+# either the old or the new file. Returns the number of bytes written, 0 when the file already held data.
+@traced()
+def save_file_atomically(file_path, data):
+    # A symbolic link is kept, the file it points to is the one replaced
+    file_path = os.path.realpath(file_path)
+
+    if file_matches(file_path, data):
+        return 0
+
+    folder_path = os.path.dirname(os.path.abspath(file_path))
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(file_path) + '.', suffix='.tmp',
+                                                  dir=folder_path)
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        # mkstemp() creates the file readable by its owner only
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_path)
+        else:
+            os.chmod(temp_path, new_file_mode)
+
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # The rename itself is only durable once the folder is synced, which Windows does not support
+    if os.name != 'nt':
+        folder_descriptor = os.open(folder_path, os.O_RDONLY)
+        try:
+            os.fsync(folder_descriptor)
+        finally:
+            os.close(folder_descriptor)
+
+    count(bytes=len(data))
+
+    return len(data)
@@ -12,10 +12,14 @@ from ykpdatabase import BasicConfig, Database
 
 
 class Commands:
-    def __init__(self):
+    def __init__(self, database=None):
         super(Commands, self).__init__()
         self.basic_config = BasicConfig()
-        self.database = Database()
+
+        # The window passes its own database, so the file is opened once
+        if database is None:
+            database = Database()
+        self.database = database
 
     def read_database_path(self):
         database_path = self.database.read_db_path()
@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from ykpdatabase import Database
+from ykpfileio import detect_encoding
+
+
+# Times are stored as epoch milliseconds
+def to_milliseconds(timestamp):
+    return int(round(timestamp * 1000))
+
+
+def read_birth_time(file_stat):
+    birth_time = getattr(file_stat, 'st_birthtime', None)
+    if birth_time is not None:
+        return birth_time
+
+    # Windows reports the creation time as st_ctime, elsewhere it is the last metadata change
+    if os.name == 'nt':
+        return file_stat.st_ctime
+
+    return file_stat.st_mtime
+
+
+# Runs in the worker processes: read and decode one file into the columns of a note
+def read_note_file(file_path):
+    try:
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        file_stat = os.stat(file_path)
+    except OSError as error:
+        return file_path, None, str(error)
+
+    head_size = 64 * 1024
+    text = data.decode(detect_encoding(data[:head_size], len(data) <= head_size), errors='replace')
+    title = os.path.splitext(os.path.basename(file_path))[0]
+
+    note = (title, text, read_birth_time(file_stat), file_stat.st_mtime, len(data))
+    return file_path, note, None
+
+
+def find_files(folder_path, extensions):
+    for root, folder_names, file_names in os.walk(folder_path):
+        folder_names.sort()
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() in extensions:
+                yield os.path.abspath(os.path.join(root, file_name))
+
+
+class Importer:
+    def __init__(self, database, workers=None, batch_size=500, max_pending=64):
+        super(Importer, self).__init__()
+
+        self.database = database
+        self.workers = workers
+        self.batch_size = batch_size
+
+        # Files handed to the workers and not taken back yet, so decoded texts do not pile up while inserts run
+        self.max_pending = max_pending
+
+        self.imported_files = 0
+        self.imported_bytes = 0
+        self.skipped_files = 0
+        self.failed_files = 0
+
+        self.imported_paths = set()
+        self.creation_times = set()
+
+    # Files already in the database are skipped, so an interrupted import continues where it stopped
+    def read_existing_notes(self):
+        with self.database.transaction() as db_cursor:
+            db_cursor.execute('SELECT file_path, creation_time FROM data')
+            for file_path, creation_time in db_cursor:
+                if file_path:
+                    self.imported_paths.add(file_path)
+                self.creation_times.add(creation_time)
+
+    # Creation times identify notes, files with the same birth time are moved apart by a millisecond
+    def make_creation_time(self, timestamp):
+        creation_time = to_milliseconds(timestamp)
+        while creation_time in self.creation_times:
+            creation_time += 1
+
+        self.creation_times.add(creation_time)
+        return creation_time
+
+    # Files with the same content, such as copies of a backup, share one stored text
+    def insert_batch(self, batch):
+        self.database.insert_records(batch)
+
+    # Results of read_note_file() in the order of file_paths, with at most max_pending files submitted at a time
+    def read_files(self, executor, file_paths):
+        pending = deque()
+        for file_path in file_paths:
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(read_note_file, file_path))
+
+        while pending:
+            yield pending.popleft().result()
+
+    def run(self, folder_path, extensions, progress=None):
+        self.read_existing_notes()
+
+        file_paths = []
+        for file_path in find_files(folder_path, extensions):
+            if file_path in self.imported_paths:
+                self.skipped_files += 1
+            else:
+                file_paths.append(file_path)
+
+        batch = []
+        batch_bytes = 0
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for file_path, note, error in self.read_files(executor, file_paths):
+                if error is not None:
+                    self.failed_files += 1
+                    print('{}: {}'.format(file_path, error), file=sys.stderr)
+                    continue
+
+                title, text, birth_time, modified_time, size = note
+                batch.append((title, text, self.make_creation_time(birth_time), to_milliseconds(modified_time),
+                              file_path))
+                batch_bytes += size
+
+                if len(batch) >= self.batch_size:
+                    self.insert_batch(batch)
+                    self.imported_files += len(batch)
+                    self.imported_bytes += batch_bytes
+                    batch = []
+                    batch_bytes = 0
+
+                    if progress is not None:
+                        progress(self.imported_files, len(file_paths))
+
+            if batch:
+                self.insert_batch(batch)
+                self.imported_files += len(batch)
+                self.imported_bytes += batch_bytes
+
+                if progress is not None:
+                    progress(self.imported_files, len(file_paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import a folder of text and HTML files into a YKPen database')
+    parser.add_argument('folder', help='folder to import, subfolders included')
+    parser.add_argument('--database', help='database file, the profile database by default')
+    parser.add_argument('--extensions', default='.txt,.htm,.html', help='comma separated file extensions')
+    parser.add_argument('--workers', type=int, help='reading processes, the number of CPUs by default')
+    parser.add_argument('--batch-size', type=int, default=500, help='notes inserted per transaction')
+    parser.add_argument('--max-pending', type=int, default=64, help='files read ahead of the inserts')
+    args = parser.parse_args()
+
+    extensions = {extension.strip().lower() for extension in args.extensions.split(',') if extension.strip()}
+
+    database = Database(args.database)
+    importer = Importer(database, args.workers, args.batch_size, args.max_pending)
+
+    def report(imported_files, total_files):
+        print('{}/{} files'.format(imported_files, total_files), flush=True)
+
+    start = time.perf_counter()
+    try:
+        importer.run(args.folder, extensions, report)
+    finally:
+        database.close_db()
+
+    duration = max(time.perf_counter() - start, 1e-9)
+    megabytes = importer.imported_bytes / (1024 * 1024)
+
+    print('Imported {} files ({:.1f} MB) in {:.2f} s: {:.0f} files/s, {:.1f} MB/s. '
+          'Skipped {} already imported, {} failed.'.format(
+              importer.imported_files, megabytes, duration, importer.imported_files / duration,
+              megabytes / duration, importer.skipped_files, importer.failed_files))
+
+    if importer.failed_files:
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import glob
+
+from PySide6.QtCore import QObject, QTimer
+from PySide6.QtGui import QTextCursor
+
+from ykpfileio import MappedTextFile
+from ykptrace import traced, count
+
+
+# A journal is a file of JSON lines, one per session, written while the editor holds text that is not in the
+# database yet ("New") or not saved to its file ("File"):
+#   {"op": "checkpoint", "context": "new" or "file", "title", "file_path", "text"} starts the text over. A file that was
+#       opened and not edited yet is referred to by "base": its path, size and modification time, instead of the text.
+#   {"op": "edit", "pos", "del", "ins"} replaces del characters at pos with ins. Positions count UTF-16 code units, as
+#       QTextDocument does.
+#   {"op": "fields", "title", "file_path"} records a changed title or file path.
+#   {"op": "clean"} marks the text as saved, there is nothing to recover.
+
+
+def process_exists(pid):
+    # Windows does not let a journal that is open in another process be renamed, see claim_journal()
+    if os.name == 'nt':
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+# Read a journal into the text it ends with, as a dict of context, title, file_path and text, or None if there is
+# nothing to recover. A line cut off by the crash ends the journal.
+def replay_journal(journal_path):
+    state = None
+    units = None
+
+    with open(journal_path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+
+            operation = record.get('op')
+            if operation == 'checkpoint':
+                state = {'context': record['context'], 'title': record['title'], 'file_path': record['file_path']}
+                text = record.get('text')
+                if text is None:
+                    text = read_base_text(record['base'])
+                    if text is None:
+                        state = None
+                        continue
+                units = bytearray(text.encode('utf-16-le'))
+            elif operation == 'edit' and state is not None:
+                position = record['pos'] * 2
+                end = min(position + record['del'] * 2, len(units))
+                units[position:end] = record['ins'].encode('utf-16-le')
+            elif operation == 'fields' and state is not None:
+                state['title'] = record['title']
+                state['file_path'] = record['file_path']
+            elif operation == 'clean':
+                state = None
+
+    if state is None:
+        return None
+
+    state['text'] = units.decode('utf-16-le', errors='replace')
+    return state
+
+
+# The text of a file a checkpoint refers to, None if the file changed since
+def read_base_text(base):
+    try:
+        file_stat = os.stat(base['file_path'])
+    except OSError:
+        return None
+
+    if file_stat.st_size != base['size'] or file_stat.st_mtime_ns != base['mtime_ns']:
+        return None
+
+    mapped_file = MappedTextFile(base['file_path'])
+    try:
+        text = ''.join(text for _, text in mapped_file.iter_chunks())
+    finally:
+        mapped_file.close()
+
+    # The edits count positions in the document, where QTextCursor.insertText() made one separator of every \r\n,
+    # \r and \n
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\u2029', '\n')
+
+
+class Journal(QObject):
+    def __init__(self, document, folder_path, describe, sync_interval=1000, min_checkpoint_size=64 * 1024):
+        super(Journal, self).__init__()
+
+        # describe() returns None when the editor text is in the database or is being loaded, otherwise a dict of
+        # context, title and file_path, and base when the text is still that of the opened file
+        self.document = document
+        self.describe = describe
+
+        self.folder_path = folder_path
+        os.makedirs(folder_path, exist_ok=True)
+        self.journal_path = os.path.join(folder_path, 'session-{}-{}.ykpj'.format(os.getpid(), int(time.time())))
+        self.file = None
+
+        # Nothing is written until the editor holds journaled text, which then starts with a checkpoint
+        self.has_checkpoint = False
+        self.clean = True
+        self.fields = None
+
+        # A new checkpoint replaces the journal once the edits since the last one add up to the size of the text, so
+        # the cost stays proportional to the edits and a replay stays short
+        self.edit_size = 0
+        self.checkpoint_size = 0
+        self.min_checkpoint_size = min_checkpoint_size
+
+        # Records reach the disk at most sync_interval after they are written
+        self.sync_timer = QTimer()
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(sync_interval)
+        self.sync_timer.timeout.connect(self.sync)
+
+        self.document.contentsChange.connect(self.record_change)
+
+    # Journals of earlier sessions whose process is gone
+    def find_recoverable(self):
+        journal_paths = []
+        for journal_path in sorted(glob.glob(os.path.join(self.folder_path, 'session-*.ykpj'))):
+            if journal_path == self.journal_path:
+                continue
+
+            try:
+                pid = int(os.path.basename(journal_path).split('-')[1])
+            except (IndexError, ValueError):
+                continue
+
+            if not process_exists(pid):
+                journal_paths.append(journal_path)
+
+        return journal_paths
+
+    # Take over the journal of a crashed session, returns the path to replay or None if its process still has it open
+    def claim_journal(self, journal_path):
+        claimed_path = journal_path + '.recovering'
+        try:
+            os.replace(journal_path, claimed_path)
+        except OSError:
+            return None
+
+        return claimed_path
+
+    def remove_journal(self, journal_path):
+        try:
+            os.remove(journal_path)
+        except OSError:
+            pass
+
+    def open_file(self, mode):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, mode, encoding='utf-8')
+
+    def append(self, record):
+        if self.file is None:
+            self.open_file('a')
+
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        self.file.write(line)
+        count(bytes=len(line))
+
+        if not self.sync_timer.isActive():
+            self.sync_timer.start()
+
+    def sync(self):
+        self.sync_timer.stop()
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    # Start the journal over with the whole text, or with a reference to the file it came from
+    @traced()
+    def write_checkpoint(self, description):
+        record = {'op': 'checkpoint', 'context': description['context'], 'title': description['title'],
+                  'file_path': description['file_path']}
+
+        base = description.get('base')
+        if base is not None:
+            record['base'] = base
+            self.checkpoint_size = self.document.characterCount()
+        else:
+            record['text'] = self.document.toPlainText()
+            self.checkpoint_size = len(record['text'])
+
+        # The journal is rewritten, the records before the checkpoint are not needed for a replay anymore
+        temporary_path = self.journal_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        os.replace(temporary_path, self.journal_path)
+
+        # Kept open, on Windows that also keeps other instances from taking the journal over
+        self.open_file('a')
+
+        self.has_checkpoint = True
+        self.clean = False
+        self.edit_size = 0
+        self.fields = (description['title'], description['file_path'])
+
+    # Called by QTextDocument.contentsChange, only the changed range of the document is read
+    @traced()
+    def record_change(self, position, removed, added):
+        if removed == 0 and added == 0:
+            return
+
+        description = self.describe()
+        if description is None:
+            self.mark_clean()
+            return
+
+        # The whole text was replaced, such as by setPlainText()
+        length = self.document.characterCount() - 1
+        if not self.has_checkpoint or added >= length or \
+                self.edit_size > max(self.checkpoint_size, self.min_checkpoint_size):
+            self.write_checkpoint(description)
+
+            # A checkpoint of the file comes before the edit, one of the text already holds it
+            if description.get('base') is None:
+                return
+
+        self.write_fields(description)
+
+        # selectedText() separates paragraphs with U+2029
+        cursor = QTextCursor(self.document)
+        cursor.setPosition(position)
+        cursor.setPosition(min(position + added, length), QTextCursor.KeepAnchor)
+        inserted = cursor.selectedText().replace('\u2029', '\n')
+
+        self.append({'op': 'edit', 'pos': position, 'del': removed, 'ins': inserted})
+        self.edit_size += len(inserted) + 1
+
+    # Called when the title or the file path changes
+    def record_fields(self):
+        description = self.describe()
+        if description is not None:
+            self.write_fields(description)
+
+    def write_fields(self, description):
+        if not self.has_checkpoint:
+            return
+
+        fields = (description['title'], description['file_path'])
+        if fields != self.fields:
+            self.fields = fields
+            self.append({'op': 'fields', 'title': fields[0], 'file_path': fields[1]})
+
+    # The text is saved or was let go, the next journaled edit starts with a new checkpoint
+    def mark_clean(self):
+        if self.clean:
+            return
+
+        self.append({'op': 'clean'})
+        self.sync()
+
+        self.clean = True
+        self.has_checkpoint = False
+        self.fields = None
+
+    # At a regular exit there is nothing to recover
+    def close(self):
+        self.sync_timer.stop()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.remove_journal(self.journal_path)
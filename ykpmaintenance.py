@@ -0,0 +1,186 @@
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+
+from ykpdatabase import Database, text_codecs
+
+
+class Maintenance:
+    def __init__(self, database, step_pages=256, free_page_ratio=0.25, full_interval=7 * 24 * 3600,
+                 full_size_limit=256 * 1024 * 1024):
+        super(Maintenance, self).__init__()
+
+        self.database = database
+
+        # Pages given back per idle step, the free page share and the age in seconds that trigger a full run
+        self.step_pages = step_pages
+        self.free_page_ratio = free_page_ratio
+        self.full_interval = full_interval
+
+        # VACUUM holds the write lock while it rewrites the file, databases above this size in bytes only get a full
+        # run from the command line
+        self.full_size_limit = full_size_limit
+
+        self.reclaimed_pages = 0
+
+        # The thread and the connection of a full run started by start_full_run()
+        self.full_run_thread = None
+        self.full_run_db = None
+
+    def read_auto_vacuum(self):
+        db = self.database.open_db()
+        return db.execute('PRAGMA auto_vacuum').fetchone()[0]
+
+    def read_size(self):
+        db = self.database.open_db()
+        page_size = db.execute('PRAGMA page_size').fetchone()[0]
+        return page_size * self.read_page_counts()[0]
+
+    def read_page_counts(self):
+        db = self.database.open_db()
+        page_count = db.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = db.execute('PRAGMA freelist_count').fetchone()[0]
+        return page_count, freelist_count
+
+    # Give back up to step_pages free pages, returns the number of pages reclaimed
+    def run_incremental_step(self, pages=None):
+        if pages is None:
+            pages = self.step_pages
+
+        # Only databases in incremental mode can shrink without a full VACUUM
+        if self.read_auto_vacuum() != 2:
+            return 0
+
+        _, freelist_count = self.read_page_counts()
+        if freelist_count == 0:
+            return 0
+
+        # The pragma frees one page per step, executescript() steps it to the end
+        db = self.database.open_db()
+        db.executescript('PRAGMA incremental_vacuum({});'.format(int(pages)))
+
+        _, remaining_count = self.read_page_counts()
+        reclaimed = freelist_count - remaining_count
+        self.reclaimed_pages += reclaimed
+
+        return reclaimed
+
+    # Whether an idle full run is due. A database that never had one counts from the first time it is seen here, so
+    # existing databases are not all rewritten at the first idle tick. Databases not in incremental mode yet are
+    # converted by an explicit full run, ykpmaintenance --full.
+    def is_full_run_due(self):
+        now = time.time()
+        last_full_run = self.database.read_meta('last_full_maintenance')
+        if last_full_run is None:
+            self.database.write_meta('last_full_maintenance', now)
+            last_full_run = now
+
+        if self.read_size() > self.full_size_limit:
+            return False
+
+        page_count, freelist_count = self.read_page_counts()
+        if page_count and freelist_count / page_count >= self.free_page_ratio:
+            return True
+
+        return now - float(last_full_run) >= self.full_interval
+
+    # VACUUM rewrites the whole file, ANALYZE and optimize refresh the query planner statistics
+    def run_full(self):
+        page_count, _ = self.read_page_counts()
+
+        db = self.database.open_db()
+        db.execute('VACUUM')
+        db.execute('ANALYZE')
+        db.execute('PRAGMA optimize')
+
+        new_page_count, _ = self.read_page_counts()
+        reclaimed = max(page_count - new_page_count, 0)
+        self.reclaimed_pages += reclaimed
+
+        self.database.write_meta('last_full_maintenance', time.time())
+
+        return reclaimed
+
+    # One unit of idle work on the database worker, returns True when a full run is due
+    def run_idle(self):
+        self.run_incremental_step()
+        return self.is_full_run_due()
+
+    # A full run gets a thread and, through it, a connection of its own, so the requests of the window only wait
+    # for the write lock and not for the whole run. Returns False if a full run is going on already.
+    def start_full_run(self):
+        if self.is_full_run_active():
+            return False
+
+        self.full_run_thread = threading.Thread(target=self.run_full_thread, name='YKPenMaintenance', daemon=True)
+        self.full_run_thread.start()
+
+        return True
+
+    def is_full_run_active(self):
+        return self.full_run_thread is not None and self.full_run_thread.is_alive()
+
+    # Runs on the maintenance thread
+    def run_full_thread(self):
+        self.full_run_db = self.database.open_db()
+        try:
+            self.run_full()
+        except sqlite3.Error as error:
+            print('Maintenance: {}'.format(error), file=sys.stderr)
+        finally:
+            self.full_run_db = None
+            self.database.close_thread_db()
+
+    # Interrupt a full run at exit, an interrupted VACUUM leaves the file as it was
+    def stop(self):
+        full_run_db = self.full_run_db
+        if full_run_db is not None:
+            full_run_db.interrupt()
+
+        if self.full_run_thread is not None:
+            self.full_run_thread.join()
+            self.full_run_thread = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reclaim free pages of a YKPen database')
+    parser.add_argument('database', nargs='?', help='database file, the profile database by default')
+    parser.add_argument('--full', action='store_true',
+                        help='run VACUUM, ANALYZE and optimize, which also switches older databases to incremental '
+                             'mode')
+    parser.add_argument('--compression', choices=sorted(text_codecs) + ['none'],
+                        help='compress stored texts with this codec and recompress the existing ones')
+    parser.add_argument('--threshold', type=int, default=4096, help='smallest text in characters to compress')
+    parser.add_argument('--rebuild-search', action='store_true',
+                        help='index every note for search again, after other programs wrote to the database')
+    args = parser.parse_args()
+
+    database = Database(args.database)
+    maintenance = Maintenance(database)
+
+    if args.compression is not None:
+        codec = None if args.compression == 'none' else args.compression
+        database.set_compression(codec, args.threshold)
+        rewritten = database.recompress()
+        print('Rewrote {} texts'.format(rewritten))
+
+    if args.rebuild_search and database.search_available:
+        database.rebuild_search_index()
+
+    if args.full:
+        maintenance.run_full()
+    else:
+        while maintenance.run_incremental_step():
+            pass
+
+    database.close_db()
+
+    print('Reclaimed {} pages'.format(maintenance.reclaimed_pages))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
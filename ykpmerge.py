@@ -0,0 +1,312 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+from ykpdatabase import Database, text_codecs
+from ykptrace import traced, span, count
+
+
+# How a note of the other database is merged when a note with the same creation time but another title or text is
+# there already. Notes with the same creation time, title and text are the same note and are never added twice.
+merge_modes = {
+    'newest': 'keep the note modified last',
+    'both': 'keep both, the added note is moved by a millisecond or more',
+    'skip': 'keep the note that is there',
+}
+
+
+class MergeError(Exception):
+    pass
+
+
+class Merger:
+    def __init__(self, database, mode='newest', chunk_size=20000):
+        super(Merger, self).__init__()
+
+        if mode not in merge_modes:
+            raise ValueError('Unknown merge mode: ' + str(mode))
+
+        self.database = database
+        self.mode = mode
+
+        # Source ids per INSERT ... SELECT, progress is reported after each chunk
+        self.chunk_size = chunk_size
+
+        self.added_notes = 0
+        self.updated_notes = 0
+        self.moved_notes = 0
+        self.duplicate_notes = 0
+        self.skipped_notes = 0
+
+        self.temporary_folder = None
+
+    # The other database must pass quick_check, use only known codecs and not come from a newer version. Older
+    # versions are upgraded on a copy, the chosen file itself is left as it is. Returns the path to merge from.
+    @traced()
+    def prepare_source(self, source_path, progress=None):
+        if not os.path.isfile(source_path):
+            raise MergeError('No such file: ' + source_path)
+
+        source = sqlite3.connect(source_path)
+        try:
+            try:
+                result = [row[0] for row in source.execute('PRAGMA quick_check')]
+            except sqlite3.DatabaseError as error:
+                raise MergeError('The file cannot be read as a database: ' + str(error))
+            if result != ['ok']:
+                raise MergeError('The database is damaged: ' + '; '.join(result[:5]))
+
+            if source.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'data'").fetchone() \
+                    is None:
+                raise MergeError('Not a YKPen database: ' + source_path)
+
+            version = source.execute('PRAGMA user_version').fetchone()[0]
+            if version > len(Database.migrations):
+                raise MergeError('The database comes from a newer version of YKPen')
+
+            if version == len(Database.migrations):
+                codecs = [row[0] for row in source.execute('SELECT DISTINCT codec FROM blobs')]
+                unknown = [codec for codec in codecs if codec is not None and codec not in text_codecs]
+                if unknown:
+                    raise MergeError('Unknown text codecs: ' + ', '.join(unknown))
+                return source_path
+
+            # The backup API also takes what is still in the write-ahead log of the source
+            self.temporary_folder = tempfile.mkdtemp(prefix='ykpmerge')
+            copy_path = os.path.join(self.temporary_folder, 'YKPen_merge_source.db')
+            copy = sqlite3.connect(copy_path)
+            try:
+                source.backup(copy)
+            finally:
+                copy.close()
+        finally:
+            source.close()
+
+        copy_database = Database(copy_path, initialize=False)
+        try:
+            copy_database.initialize_db(progress)
+        finally:
+            copy_database.close_db()
+
+        return copy_path
+
+    def remove_temporary_folder(self):
+        if self.temporary_folder is not None:
+            shutil.rmtree(self.temporary_folder, ignore_errors=True)
+            self.temporary_folder = None
+
+    # Merge the notes of the database at source_path into this one, in a single transaction. progress, if given, is
+    # called as progress(step, done, total).
+    @traced()
+    def run(self, source_path, progress=None):
+        try:
+            merge_path = self.prepare_source(source_path, progress)
+
+            db = self.database.open_db()
+            db.execute('ATTACH DATABASE ? AS merge_source', (merge_path,))
+            try:
+                with self.database.transaction(write=True) as db_cursor:
+                    self.merge(db_cursor, progress)
+            finally:
+                db.execute('DETACH DATABASE merge_source')
+                # Notes may have been updated from the other database
+                self.database.record_cache.clear()
+        finally:
+            self.remove_temporary_folder()
+
+    def report(self, progress, step, done, total):
+        if progress is not None:
+            progress(step, done, total)
+
+    # Run db_command once per chunk of source ids, the command takes the lowest and the highest id of the chunk
+    def run_chunks(self, db_cursor, db_command, table_name, step, progress):
+        db_cursor.execute('SELECT MIN(rowid), MAX(rowid) FROM ' + table_name)
+        first_id, last_id = db_cursor.fetchone()
+        if first_id is None:
+            return 0
+
+        changed = 0
+        total = last_id - first_id + 1
+        for low in range(first_id, last_id + 1, self.chunk_size):
+            high = min(low + self.chunk_size - 1, last_id)
+            db_cursor.execute(db_command, (low, high))
+            changed += max(db_cursor.rowcount, 0)
+            self.report(progress, step, high - first_id + 1, total)
+
+        return changed
+
+    def merge(self, db_cursor, progress):
+        # Every source note is matched to the note with its creation time here, if there is one
+        with span('Merger.classify'):
+            db_cursor.execute('DROP TABLE IF EXISTS temp.merge_rows')
+            db_cursor.execute('CREATE TEMP TABLE merge_rows (source_id INTEGER PRIMARY KEY, main_id INTEGER, '
+                              'duplicate INTEGER, newer INTEGER)')
+            db_cursor.execute(
+                'INSERT INTO merge_rows (source_id, main_id, duplicate, newer) '
+                'SELECT source.id, main_data.id, '
+                'main_data.id IS NOT NULL AND source.title IS main_data.title '
+                'AND source.text_hash IS main_data.text_hash, '
+                'COALESCE(source.last_modified_time, source.creation_time) > '
+                'COALESCE(main_data.last_modified_time, main_data.creation_time) '
+                'FROM merge_source.data AS source '
+                'LEFT JOIN main.data AS main_data ON main_data.creation_time = source.creation_time'
+            )
+
+            db_cursor.execute('SELECT COUNT(*) FROM merge_rows WHERE duplicate')
+            self.duplicate_notes = db_cursor.fetchone()[0]
+
+            # Notes added by the merge get ids above this one and are indexed for search at the end
+            db_cursor.execute('SELECT COALESCE(MAX(id), 0) FROM main.data')
+            last_id = db_cursor.fetchone()[0]
+
+        # Texts come over first, the blob triggers count the references of the notes that use them and the ones
+        # no merged note uses are removed at the end
+        with span('Merger.copy_texts'):
+            self.run_chunks(
+                db_cursor,
+                'INSERT OR IGNORE INTO main.blobs (hash, codec, content) '
+                'SELECT hash, codec, content FROM merge_source.blobs WHERE rowid BETWEEN ? AND ?',
+                'merge_source.blobs', 'Copying texts', progress)
+
+        with span('Merger.add_notes'):
+            self.added_notes = self.run_chunks(
+                db_cursor,
+                'INSERT INTO main.data (title, text_hash, creation_time, last_modified_time, file_path, size) '
+                'SELECT source.title, source.text_hash, source.creation_time, source.last_modified_time, '
+                'source.file_path, source.size FROM merge_rows '
+                'JOIN merge_source.data AS source ON source.id = merge_rows.source_id '
+                'WHERE merge_rows.main_id IS NULL AND merge_rows.source_id BETWEEN ? AND ? '
+                'ORDER BY source.id',
+                'merge_rows', 'Adding notes', progress)
+
+        with span('Merger.resolve_conflicts'):
+            db_cursor.execute('SELECT COUNT(*) FROM merge_rows WHERE main_id IS NOT NULL AND NOT duplicate')
+            conflicts = db_cursor.fetchone()[0]
+
+            if self.mode == 'newest':
+                db_cursor.execute(
+                    'SELECT merge_rows.main_id, source.text_hash FROM merge_rows '
+                    'JOIN merge_source.data AS source ON source.id = merge_rows.source_id '
+                    'WHERE merge_rows.main_id IS NOT NULL AND NOT merge_rows.duplicate AND merge_rows.newer'
+                )
+                updates = db_cursor.fetchall()
+                updated_ids = [id_number for id_number, _ in updates]
+
+                # The texts being replaced are kept as revisions, as for any other update
+                for id_number, text_hash in updates:
+                    self.database.capture_revision(db_cursor, id_number, text_hash)
+
+                self.database.unindex_notes(db_cursor, updated_ids)
+
+                db_cursor.execute(
+                    'UPDATE main.data SET (title, text_hash, last_modified_time, file_path, size) = '
+                    '(SELECT source.title, source.text_hash, source.last_modified_time, source.file_path, source.size '
+                    'FROM merge_source.data AS source WHERE source.creation_time = data.creation_time) '
+                    'WHERE id IN (SELECT main_id FROM merge_rows '
+                    'WHERE main_id IS NOT NULL AND NOT duplicate AND newer)'
+                )
+                self.updated_notes = max(db_cursor.rowcount, 0)
+                self.skipped_notes = conflicts - self.updated_notes
+
+                self.database.index_notes(db_cursor, updated_ids)
+            elif self.mode == 'both':
+                self.moved_notes = self.add_moved_notes(db_cursor, progress)
+            else:
+                self.skipped_notes = conflicts
+
+        self.database.index_notes_after(db_cursor, last_id)
+
+        db_cursor.execute('DELETE FROM main.blobs WHERE refcount <= 0')
+        db_cursor.execute('DROP TABLE temp.merge_rows')
+
+        count(rows=self.added_notes + self.updated_notes + self.moved_notes)
+
+    # Conflicting notes get the next free creation times. Both the conflicting times and the taken ones are walked
+    # once in ascending order, which stays linear where creation times are dense, such as notes imported within the
+    # same second. Only the conflicting notes pass through Python, the notes themselves are copied by SQL.
+    def add_moved_notes(self, db_cursor, progress):
+        db_cursor.execute('DROP TABLE IF EXISTS temp.merge_moved')
+        db_cursor.execute('CREATE TEMP TABLE merge_moved (source_id INTEGER PRIMARY KEY, new_time INTEGER)')
+
+        db_cursor.execute(
+            'SELECT source.id, source.creation_time FROM merge_rows '
+            'JOIN merge_source.data AS source ON source.id = merge_rows.source_id '
+            'WHERE merge_rows.main_id IS NOT NULL AND NOT merge_rows.duplicate ORDER BY source.creation_time'
+        )
+        conflicts = db_cursor.fetchall()
+        if not conflicts:
+            return 0
+
+        taken_cursor = self.database.open_db().cursor()
+        taken_cursor.execute('SELECT creation_time FROM main.data WHERE creation_time > ? ORDER BY creation_time',
+                             (conflicts[0][1],))
+        taken = taken_cursor.fetchone()
+
+        moved = []
+        new_time = None
+        for source_id, creation_time in conflicts:
+            new_time = creation_time + 1 if new_time is None else max(creation_time + 1, new_time + 1)
+            while taken is not None and taken[0] <= new_time:
+                if taken[0] == new_time:
+                    new_time += 1
+                taken = taken_cursor.fetchone()
+            moved.append((source_id, new_time))
+
+        # An unfinished statement would keep the tables locked
+        taken_cursor.close()
+
+        db_cursor.executemany('INSERT INTO merge_moved (source_id, new_time) VALUES (?, ?)', moved)
+        self.report(progress, 'Moving conflicting notes', len(moved), len(conflicts))
+
+        db_cursor.execute(
+            'INSERT INTO main.data (title, text_hash, creation_time, last_modified_time, file_path, size) '
+            'SELECT source.title, source.text_hash, merge_moved.new_time, source.last_modified_time, '
+            'source.file_path, source.size FROM merge_moved '
+            'JOIN merge_source.data AS source ON source.id = merge_moved.source_id ORDER BY source.id'
+        )
+        moved = max(db_cursor.rowcount, 0)
+
+        db_cursor.execute('DROP TABLE temp.merge_moved')
+
+        return moved
+
+    def describe(self):
+        return 'Added {} notes, updated {}, moved {}, skipped {} conflicting and {} duplicates'.format(
+            self.added_notes, self.updated_notes, self.moved_notes, self.skipped_notes, self.duplicate_notes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the notes of another YKPen database into this one')
+    parser.add_argument('source', help='database to merge from, older versions are upgraded on a copy')
+    parser.add_argument('--database', help='database file, the profile database by default')
+    parser.add_argument('--mode', choices=sorted(merge_modes), default='newest',
+                        help='notes with the same creation time but another text: ' +
+                             ', '.join('{} = {}'.format(mode, text) for mode, text in sorted(merge_modes.items())))
+    args = parser.parse_args()
+
+    database = Database(args.database)
+    merger = Merger(database, args.mode)
+
+    def report(step, done, total):
+        print('{}: {}/{}'.format(step, done, total), flush=True)
+
+    start = time.perf_counter()
+    try:
+        merger.run(args.source, report)
+    except MergeError as error:
+        print(error, file=sys.stderr)
+        return 1
+    finally:
+        database.close_db()
+
+    print('{} in {:.2f} s'.format(merger.describe(), time.perf_counter() - start))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
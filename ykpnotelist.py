@@ -0,0 +1,198 @@
+from bisect import bisect_left
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+
+from ykpdatabase import format_time
+from ykptrace import traced
+
+
+# Notes are listed by creation time, notes without one by id
+def make_label(id_number, creation_time):
+    if creation_time is None:
+        return 'Note {}'.format(id_number)
+    return format_time(creation_time)
+
+
+class NoteListModel(QAbstractListModel):
+    # database is an AsyncDatabase, pages are read on its worker and added when they arrive
+    def __init__(self, database, page_size=200):
+        super(NoteListModel, self).__init__()
+
+        self.database = database
+        self.page_size = page_size
+
+        # The fixed entries come first, then the notes from newest to oldest as (id, label)
+        self.fixed_items = ["New", "File"]
+        self.notes = []
+        self.all_fetched = False
+
+        # Nothing is read while the database is not ready yet, see wait_for_database()
+        self.waiting = False
+
+        # A page is on its way; reload() bumps the generation so pages requested before it are dropped
+        self.fetching = False
+        self.generation = 0
+
+        # (id, callback) of load_note() calls waiting for their note to be loaded
+        self.pending_loads = []
+
+        # Ids of the loaded notes, the rows themselves are found by id_to_row()
+        self.loaded_ids = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.fixed_items) + len(self.notes)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = index.row()
+
+        if role == Qt.DisplayRole:
+            if row < len(self.fixed_items):
+                return self.fixed_items[row]
+            return self.notes[row - len(self.fixed_items)][1]
+
+        if role == Qt.UserRole:
+            if row < len(self.fixed_items):
+                return None
+            return self.notes[row - len(self.fixed_items)][0]
+
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.waiting or self.fetching:
+            return False
+        return not self.all_fetched
+
+    # Keyset pagination: the next page starts below the oldest id loaded so far
+    @traced()
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.all_fetched or self.waiting or self.fetching:
+            return
+
+        if self.notes:
+            before_id = self.notes[-1][0]
+        else:
+            before_id = None
+
+        self.fetching = True
+        generation = self.generation
+        self.database.read_ids_page(before_id, self.page_size,
+                                    callback=lambda page: self.receive_page(generation, page))
+
+    def receive_page(self, generation, page):
+        if generation != self.generation:
+            return
+
+        self.fetching = False
+        self.append_page(page)
+
+    def wait_for_database(self):
+        self.waiting = True
+
+    # Add a page of (id, creation time) read elsewhere, such as the first page read on a worker thread at startup
+    def append_page(self, page):
+        self.waiting = False
+
+        if len(page) < self.page_size:
+            self.all_fetched = True
+
+        # Notes added by add_note() while the page was on its way are there already
+        page = [(id_number, make_label(id_number, creation_time)) for id_number, creation_time in page
+                if id_number not in self.loaded_ids]
+
+        if page:
+            first_row = self.rowCount()
+            self.beginInsertRows(QModelIndex(), first_row, first_row + len(page) - 1)
+            self.notes.extend(page)
+            self.loaded_ids.update(id_number for id_number, _ in page)
+            self.endInsertRows()
+
+        self.continue_loading()
+
+    @traced()
+    def reload(self):
+        self.beginResetModel()
+        self.notes = []
+        self.loaded_ids = set()
+        self.all_fetched = False
+        self.fetching = False
+        self.generation += 1
+        self.endResetModel()
+
+        self.fetchMore()
+
+    # Notes are ordered by descending id, so the row is found by bisection
+    def id_to_row(self, id_number):
+        if id_number not in self.loaded_ids:
+            return -1
+
+        i = bisect_left(self.notes, -id_number, key=lambda note: -note[0])
+        return len(self.fixed_items) + i
+
+    # The ids of the loaded notes up to distance rows above and below the note, nearest first
+    def neighbour_ids(self, id_number, distance=1):
+        row = self.id_to_row(id_number)
+        if row < 0:
+            return []
+
+        i = row - len(self.fixed_items)
+        id_numbers = []
+        for offset in range(1, distance + 1):
+            for j in (i - offset, i + offset):
+                if 0 <= j < len(self.notes):
+                    id_numbers.append(self.notes[j][0])
+
+        return id_numbers
+
+    # Fetch pages until the note is loaded, then callback gets its row or -1 if it does not exist
+    @traced()
+    def load_note(self, id_number, callback):
+        self.pending_loads.append((id_number, callback))
+        self.continue_loading()
+
+    def continue_loading(self):
+        while self.pending_loads:
+            id_number, callback = self.pending_loads[0]
+
+            # Pages go down by id, once past the id the note cannot come anymore
+            if id_number in self.loaded_ids or self.all_fetched or (self.notes and self.notes[-1][0] < id_number):
+                self.pending_loads.pop(0)
+                callback(self.id_to_row(id_number))
+                continue
+
+            # The next page calls back here once it has arrived
+            self.fetchMore()
+            return
+
+    # Notes go in by descending id: new ones of this window right after the fixed entries, ones written by other
+    # windows wherever they belong. A note below the loaded pages is left for fetchMore(), the row is -1 then.
+    def add_note(self, id_number, creation_time):
+        if id_number in self.loaded_ids:
+            return self.id_to_row(id_number)
+
+        i = bisect_left(self.notes, -id_number, key=lambda note: -note[0])
+        if i == len(self.notes) and self.notes and not self.all_fetched:
+            return -1
+
+        label = make_label(id_number, creation_time)
+        row = len(self.fixed_items) + i
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.notes.insert(i, (id_number, label))
+        self.loaded_ids.add(id_number)
+        self.endInsertRows()
+
+        return row
+
+    def remove_note(self, id_number):
+        row = self.id_to_row(id_number)
+        if row < 0:
+            return
+
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.notes[row - len(self.fixed_items)]
+        self.loaded_ids.discard(id_number)
+        self.endRemoveRows()
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+from collections import deque
+
+
+# Tracing is switched on by the YKP_TRACE environment variable: 1 prints a summary at exit, a path ending in .json
+# gets a Chrome trace (chrome://tracing, Perfetto), any other path gets the summary. Off, traced() returns the
+# functions unchanged and span() a shared object that does nothing.
+trace_setting = os.environ.get('YKP_TRACE', '')
+enabled = trace_setting not in ('', '0')
+
+# The most recent spans as (name, start, duration, thread id, counters), older ones are dropped
+events = deque(maxlen=int(os.environ.get('YKP_TRACE_SIZE', 100000)))
+
+origin = time.perf_counter()
+local = threading.local()
+
+# Upper bounds of the histogram buckets in milliseconds
+bucket_bounds = [0.01, 0.1, 1, 10, 100, 1000, float('inf')]
+
+
+def read_stack():
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+        stack = []
+        local.stack = stack
+    return stack
+
+
+class Span:
+    __slots__ = ('name', 'start', 'counters')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.counters = None
+
+    def __enter__(self):
+        read_stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        duration = time.perf_counter() - self.start
+        read_stack().pop()
+        events.append((self.name, self.start, duration, threading.get_ident(), self.counters))
+        return False
+
+    # Add amounts such as rows=10 or bytes=4096 to the span
+    def count(self, **amounts):
+        if self.counters is None:
+            self.counters = {}
+        for key, amount in amounts.items():
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+    def count(self, **amounts):
+        pass
+
+
+null_span = NullSpan()
+
+
+def span(name):
+    if not enabled:
+        return null_span
+    return Span(name)
+
+
+# Add amounts to the innermost span open on this thread
+def count(**amounts):
+    if not enabled:
+        return
+
+    stack = getattr(local, 'stack', None)
+    if stack:
+        stack[-1].count(**amounts)
+
+
+# Record every call of the decorated function as a span, named after the function unless name is given
+def traced(name=None):
+    def decorate(function):
+        if not enabled:
+            return function
+
+        span_name = name or function.__qualname__
+
+        # Qt passes all arguments of a signal to callables taking *args, they are cut to what the function takes,
+        # as Qt does for plain functions
+        code = function.__code__
+        positional = None if code.co_flags & 0x04 else code.co_argcount
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if positional is not None:
+                args = args[:positional]
+            with Span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def clear():
+    events.clear()
+
+
+def export_chrome_trace(file_path):
+    process_id = os.getpid()
+    trace_events = []
+    for name, start, duration, thread_id, counters in list(events):
+        trace_events.append({
+            'name': name,
+            'cat': name.split('.')[0],
+            'ph': 'X',
+            'ts': (start - origin) * 1000000,
+            'dur': duration * 1000000,
+            'pid': process_id,
+            'tid': thread_id,
+            'args': counters or {},
+        })
+
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+
+
+# Statistics per span name: calls, durations in milliseconds, summed counters and a histogram over bucket_bounds
+def summarize():
+    durations = {}
+    counters = {}
+    for name, _, duration, _, span_counters in list(events):
+        durations.setdefault(name, []).append(duration * 1000)
+        if span_counters:
+            totals = counters.setdefault(name, {})
+            for key, amount in span_counters.items():
+                totals[key] = totals.get(key, 0) + amount
+
+    summary = {}
+    for name, values in durations.items():
+        values.sort()
+        histogram = [0] * len(bucket_bounds)
+        for value in values:
+            histogram[next(i for i, bound in enumerate(bucket_bounds) if value <= bound)] += 1
+
+        summary[name] = {
+            'calls': len(values),
+            'total_ms': sum(values),
+            'mean_ms': sum(values) / len(values),
+            'median_ms': values[len(values) // 2],
+            'p95_ms': values[int(len(values) * 0.95)],
+            'max_ms': values[-1],
+            'counters': counters.get(name, {}),
+            'histogram': histogram,
+        }
+
+    return summary
+
+
+def write_summary(file=sys.stderr):
+    summary = summarize()
+
+    labels = ['<=' + format(bound, 'g') for bound in bucket_bounds[:-1]] + ['>' + format(bucket_bounds[-2], 'g')]
+    print('{:<40} {:>7} {:>10} {:>9} {:>9} {:>9}  {}  {}'.format(
+        'span', 'calls', 'total ms', 'median', 'p95', 'max', ' '.join('{:>6}'.format(label) for label in labels),
+        'counters'), file=file)
+
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]['total_ms']):
+        line = '{:<40} {:7d} {:10.2f} {:9.3f} {:9.3f} {:9.3f}  {}  {}'.format(
+            name, stats['calls'], stats['total_ms'], stats['median_ms'], stats['p95_ms'], stats['max_ms'],
+            ' '.join('{:6d}'.format(amount) for amount in stats['histogram']),
+            ' '.join('{}={}'.format(key, amount) for key, amount in sorted(stats['counters'].items())))
+        print(line.rstrip(), file=file)
+
+
+def write_trace():
+    if trace_setting == '1':
+        write_summary()
+    elif trace_setting.endswith('.json'):
+        export_chrome_trace(trace_setting)
+    else:
+        with open(trace_setting, 'w', encoding='utf-8') as file:
+            write_summary(file)
+
+
+if enabled:
+    atexit.register(write_trace)